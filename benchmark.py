@@ -0,0 +1,408 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import subprocess
+import tempfile
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import numpy as np
+
+# Benchmark suite for the forecasting service. It generates a synthetic catalog in the
+# layout dataset_cleaning.py writes (and a raw export for the cleaning pipeline itself),
+# points sarima.py at it through DATA_PATH, times each stage and writes the timings as
+# JSON. Passing an earlier results file as --baseline compares against it and exits
+# non-zero when a stage got slower than the tolerance allows.
+# Everything is seeded, so two runs with the same arguments see the same data.
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+STAGES = ["load", "service_init", "train", "model_load", "forecast", "detect_stockout", "plot",
+          "add_data", "cleaning", "serve"]
+# Stages measured as throughput; higher is better
+THROUGHPUT_STAGES = {"serve"}
+REGRESSION_TOLERANCE = 0.25
+
+
+def generate_catalog(products, days, seed=0, end_date="2024-12-31", sparse_fraction=0.0):
+    # One (products x days) matrix per column, flattened product-major at the end.
+    # Sales are Poisson around a per-product level with weekly seasonality and a
+    # trend; sparse products sell rarely, which leaves them without a SARIMAX model.
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(end=end_date, periods=days)
+    t = np.arange(days)
+    level = rng.gamma(2.0, 10.0, size=(products, 1)) + 1
+    weekly = 1 + rng.uniform(0.1, 0.4, (products, 1)) * np.sin(2 * np.pi * (t + rng.integers(0, 7, (products, 1))) / 7)
+    trend = 1 + rng.normal(0, 0.3, (products, 1)) * t / days
+    sales = rng.poisson(np.clip(level * weekly * trend, 0.1, None)).astype(float)
+    sparse = rng.random(products) < sparse_fraction
+    sales[sparse] = rng.poisson(0.02, (int(sparse.sum()), days))
+
+    def lag(k):
+        lagged = np.repeat(sales.mean(axis=1, keepdims=True), days, axis=1)
+        if k < days:
+            lagged[:, k:] = sales[:, :days - k]
+        return lagged
+
+    by_day = pd.DataFrame(sales.T)
+    dow = dates.dayofweek.to_numpy()
+    seasonality = np.empty_like(sales)
+    for day in range(7):
+        seasonality[:, dow == day] = sales[:, dow == day].mean(axis=1, keepdims=True)
+    price = np.repeat(rng.uniform(5, 200, (products, 1)), days, axis=1) * rng.uniform(0.95, 1.05, (products, days))
+    cost = price * rng.uniform(0.5, 0.8, (products, 1))
+    discount = price * rng.choice([0, 0, 0, 0.1, 0.2], (products, days))
+    lead_time = rng.integers(2, 15, (products, 1))
+    opening = np.round(level * rng.uniform(20, 40, (products, 1))) * np.ones((1, days))
+    per_product = lambda values: np.repeat(values, days, axis=1)
+
+    columns = {
+        "product_id": np.repeat([f"P{i:06d}" for i in range(products)], days),
+        "Date": np.tile(dates.to_numpy(), products),
+        "Sales Volume": sales,
+        "Opening Stock Level": opening,
+        "Remaining Stock Level": np.maximum(opening - sales, 0),
+        "Reorder Point": per_product(np.round(level * lead_time)),
+        "Lead Time (Days)": per_product(lead_time),
+        "selling_price": price,
+        "Seasonality_Score": seasonality,
+        "Revenue": price * sales,
+        "Demand_Volatility": per_product(sales.std(axis=1, keepdims=True) / np.maximum(sales.mean(axis=1, keepdims=True), 1e-9)),
+        "Purchase_Frequency": per_product(rng.integers(1, 30, (products, 1))),
+        "Customer_Purchase_Frequency": per_product(rng.integers(1, 10, (products, 1))),
+        "Sales_Lag_7": lag(7),
+        "Sales_Lag_30": lag(30),
+        "Sales_Lag_60": lag(60),
+        "Sales_Lag_90": lag(90),
+        "Sales_Rolling_Mean_7": by_day.rolling(7, min_periods=1).mean().to_numpy().T,
+        "Sales_Rolling_Std_7": by_day.rolling(7, min_periods=2).std().fillna(0).to_numpy().T,
+        "Sales_EMA_7": by_day.ewm(span=7).mean().to_numpy().T,
+        "Profit_Margin": (price - cost) / price,
+        "Discount_Rate": discount / price,
+        "Holiday": (rng.random((1, days)) < 0.03).astype(int) * np.ones((products, 1), dtype=int),
+        "Quarter": np.tile(dates.quarter.to_numpy(), (products, 1)),
+        "Is_Weekend": np.tile((dow >= 5).astype(int), (products, 1)),
+        "category": np.repeat([f"Category {i % 12}" for i in range(products)], days),
+        "brand": np.repeat([f"Brand {i % 40}" for i in range(products)], days),
+        "supplier_name": np.repeat([f"Supplier {i % 25}" for i in range(products)], days),
+    }
+    return pd.DataFrame({name: np.asarray(values).reshape(-1) for name, values in columns.items()})
+
+
+def generate_raw(products, seed=0):
+    # Raw export for dataset_cleaning.py: 365 days per product (the cleaner keeps only
+    # products with exactly that many), the raw column names and string dates
+    import dataset_cleaning
+
+    df = generate_catalog(products, dataset_cleaning.min_data_points, seed=seed)
+    rng = np.random.default_rng(seed + 1)
+    rows = len(df)
+    df["Date"] = df["Date"].dt.strftime("%Y-%m-%d")
+    df["Stock-out Date"] = ""
+    df["Seasonality"] = df["Seasonality_Score"]
+    df["Purchase Frequency"] = df["Purchase_Frequency"]
+    df["product_name"] = "Product " + df["product_id"]
+    df["cost_price"] = df["selling_price"] * (1 - df["Profit_Margin"])
+    df["discount"] = df["selling_price"] * df["Discount_Rate"]
+    df["product_lifecycle"] = rng.choice(["Introduction", "Growth", "Maturity", "Decline"], rows)
+    df["reliability_score"] = rng.uniform(0.5, 1, rows)
+    df["Delivery_time"] = rng.integers(1, 10, rows)
+    df["defect_rate"] = rng.uniform(0, 0.05, rows)
+    df["Price_Elasticity"] = rng.normal(-1, 0.3, rows)
+    df["shipping_method"] = rng.choice(["Air", "Ground", "Sea"], rows)
+    df["estimated_delivery_days"] = rng.integers(1, 10, rows)
+    df["delay_days"] = rng.integers(0, 3, rows)
+    df["On-Time Delivery Rate (%)"] = rng.uniform(80, 100, rows)
+    df["Order Fulfillment Time (Days)"] = rng.integers(1, 5, rows)
+    return df[[col for col in dataset_cleaning.columns_to_keep if col in df.columns]]
+
+
+def summarize(times):
+    times = np.asarray(times, dtype=float)
+    return {
+        "runs": int(len(times)),
+        "min_s": float(times.min()),
+        "median_s": float(np.median(times)),
+        "p95_s": float(np.percentile(times, 95)),
+        "mean_s": float(times.mean()),
+    }
+
+
+def timed(fn, runs):
+    times = []
+    for run in range(runs):
+        started = time.perf_counter()
+        fn(run)
+        times.append(time.perf_counter() - started)
+    return summarize(times)
+
+
+def service_class(sarima):
+    # The undecorated class behind the Serve deployment, to drive it in-process
+    deployment = sarima.ForecastingService.func_or_class
+    return [cls for cls in deployment.__mro__[1:] if cls.__name__ == "ForecastingService"][0]
+
+
+def bench_service(args, sarima, results):
+    if "load" in args.stages:
+        results["load"] = timed(lambda _: sarima.build_store(sarima.load_dataset()), args.repeat)
+        results["load"]["store_mib"] = sarima.build_store(sarima.load_dataset())["frame"].memory_usage(deep=True).sum() / 2**20
+        print(f"load: {results['load']['median_s']:.3f}s, {results['load']['store_mib']:.1f} MiB in memory")
+
+    started = time.perf_counter()
+    cls = service_class(sarima)
+    svc = cls.__new__(cls)
+    cls.__init__(svc)
+    if "service_init" in args.stages:
+        results["service_init"] = summarize([time.perf_counter() - started])
+        print(f"service_init: {results['service_init']['median_s']:.3f}s")
+
+    # Sample products spread over the catalog; data-poor ones can't be trained
+    trainable = [pid for pid in svc.product_ids if not svc.data_poor(pid)]
+    sample = trainable[::max(1, len(trainable) // args.sample_products)][:args.sample_products]
+    end = max(svc.get_partition(pid).index[-1] for pid in sample)
+    start_date = (end + pd.Timedelta(days=1)).strftime("%Y-%m-%d")
+    end_date = (end + pd.Timedelta(days=args.horizon)).strftime("%Y-%m-%d")
+
+    # Cold fits, one product per run
+    if "train" in args.stages:
+        results["train"] = timed(lambda run: svc.load_or_train_model(sample[run]), len(sample))
+        print(f"train: {results['train']['median_s']:.3f}s per product")
+    for pid in sample:
+        svc.get_model(pid)
+
+    def load_model(run):
+        pid = sample[run % len(sample)]
+        svc.fitted_models.pop(pid, None)
+        svc.load_or_train_model(pid)
+
+    if "model_load" in args.stages:
+        results["model_load"] = timed(load_model, args.repeat)
+        print(f"model_load: {results['model_load']['median_s'] * 1000:.1f}ms")
+
+    forecasts = {pid: svc.forecast(pid, start_date, end_date) for pid in sample}
+    stages = {
+        "forecast": lambda run: svc.forecast(sample[run % len(sample)], start_date, end_date),
+        "detect_stockout": lambda run: svc.detect_stockout(sample[run % len(sample)], forecasts[sample[run % len(sample)]]),
+    }
+    for stage, fn in stages.items():
+        if stage in args.stages:
+            results[stage] = timed(fn, args.repeat)
+            print(f"{stage}: {results[stage]['median_s'] * 1000:.1f}ms")
+
+    # Rendering only: the prediction is cached and the rendered PNG dropped each run
+    def plot(run):
+        pid = sample[run % len(sample)]
+        _, _, entry = svc.cached_prediction(pid, start_date, end_date)
+        entry["plots"].clear()
+        svc.plot_png(pid, start_date, end_date)
+
+    if "plot" in args.stages:
+        for pid in sample:
+            svc.cached_prediction(pid, start_date, end_date)
+        results["plot"] = timed(plot, args.repeat)
+        print(f"plot: {results['plot']['median_s'] * 1000:.1f}ms")
+
+    # One new day per run, appended after the product's last date
+    def add_data(run):
+        pid = sample[run % len(sample)]
+        last = svc.get_partition(pid).iloc[-1]
+        svc.ingest_row(sarima.NewDataRequest(
+            product_id=pid,
+            date=(svc.get_partition(pid).index[-1] + pd.Timedelta(days=1)).strftime("%Y-%m-%d"),
+            sales_volume=float(last["Sales Volume"] if pd.notna(last["Sales Volume"]) else 0),
+            opening_stock_level=int(last["Opening Stock Level"]),
+            remaining_stock_level=int(last["Remaining Stock Level"])))
+
+    if "add_data" in args.stages:
+        results["add_data"] = timed(add_data, args.repeat)
+        print(f"add_data: {results['add_data']['median_s'] * 1000:.1f}ms")
+    return sample
+
+
+def bench_cleaning(args, workdir, results):
+    raw_path = os.path.join(workdir, "raw_export.csv")
+    generate_raw(args.clean_products, seed=args.seed).to_csv(raw_path, index=False)
+    output = os.path.join(workdir, "cleaning", "cleaned_dataset.csv")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    command = [sys.executable, os.path.join(REPO_DIR, "dataset_cleaning.py"), "--input", raw_path,
+               "--output", output, "--workers", str(args.workers)]
+    results["cleaning"] = timed(lambda _: subprocess.run(command, check=True, stdout=subprocess.DEVNULL), 1)
+    results["cleaning"]["products"] = args.clean_products
+    print(f"cleaning: {results['cleaning']['median_s']:.2f}s for {args.clean_products} products")
+
+
+def bench_serve(args, env, sample, results):
+    import ray
+    from ray import serve
+    import sarima
+
+    # Replicas start in the working directory and need the repo on their path
+    ray.init(ignore_reinit_error=True, include_dashboard=False, log_to_driver=False,
+             runtime_env={"env_vars": {**env, "PYTHONPATH": REPO_DIR}})
+    try:
+        serve.start(http_options={"host": "127.0.0.1", "port": args.port})
+        serve.run(sarima.ForecastingService.bind(), name="benchmark", route_prefix="/")
+        url = f"http://127.0.0.1:{args.port}/predict"
+        end = pd.Timestamp(args.end_date)
+        start_date = (end + pd.Timedelta(days=1)).strftime("%Y-%m-%d")
+        end_date = (end + pd.Timedelta(days=args.horizon)).strftime("%Y-%m-%d")
+
+        def request(index):
+            body = json.dumps({"product_id": sample[index % len(sample)], "start_date": start_date,
+                               "end_date": end_date}).encode("utf-8")
+            started = time.perf_counter()
+            try:
+                with urllib.request.urlopen(urllib.request.Request(
+                        url, data=body, headers={"Content-Type": "application/json"}), timeout=120) as response:
+                    status, payload = response.status, json.loads(response.read())
+            except urllib.error.HTTPError as e:
+                status, payload = e.code, {}
+            return time.perf_counter() - started, status, bool(payload.get("fallback"))
+
+        # Warm-up round so replica start-up and first fits aren't counted
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            list(pool.map(request, range(len(sample))))
+            started = time.perf_counter()
+            outcomes = list(pool.map(request, range(args.requests)))
+            elapsed = time.perf_counter() - started
+    finally:
+        serve.shutdown()
+        ray.shutdown()
+
+    latencies = np.array([latency for latency, _, _ in outcomes])
+    statuses = pd.Series([status for _, status, _ in outcomes]).value_counts()
+    results["serve"] = {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "requests_per_s": args.requests / elapsed,
+        "latency_p50_s": float(np.percentile(latencies, 50)),
+        "latency_p95_s": float(np.percentile(latencies, 95)),
+        "latency_p99_s": float(np.percentile(latencies, 99)),
+        "statuses": {str(status): int(count) for status, count in statuses.items()},
+        "fallback_share": float(np.mean([fallback for _, _, fallback in outcomes])),
+    }
+    print(f"serve: {results['serve']['requests_per_s']:.1f} req/s, p95 {results['serve']['latency_p95_s'] * 1000:.0f}ms")
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    versions = {}
+    for package in ("numpy", "pandas", "statsmodels", "ray"):
+        try:
+            versions[package] = __import__(package).__version__
+        except ImportError:
+            versions[package] = None
+    return {"commit": commit or None, "python": platform.python_version(), "platform": platform.platform(),
+            "cpus": os.cpu_count(), "packages": versions}
+
+
+# Stages slower (or, for throughput, lower) than the baseline by more than the tolerance
+def compare(results, baseline, tolerance):
+    regressions = []
+    for stage, current in results["stages"].items():
+        previous = baseline.get("stages", {}).get(stage)
+        if not previous:
+            continue
+        if stage in THROUGHPUT_STAGES:
+            ratio = previous["requests_per_s"] / current["requests_per_s"]
+        else:
+            ratio = current["median_s"] / previous["median_s"]
+        marker = "REGRESSION" if ratio > 1 + tolerance else "ok"
+        print(f"  {stage:<16} {ratio:6.2f}x baseline  {marker}")
+        if ratio > 1 + tolerance:
+            regressions.append(stage)
+    if baseline.get("config") != results["config"]:
+        print("⚠️ Baseline was recorded with a different configuration; ratios may not be comparable.")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the forecasting service on a synthetic catalog")
+    parser.add_argument("--products", type=int, default=200, help="Products in the synthetic catalog")
+    parser.add_argument("--days", type=int, default=365, help="Days of history per product")
+    parser.add_argument("--sparse-fraction", type=float, default=0.05, help="Share of rarely-selling products")
+    parser.add_argument("--end-date", default="2024-12-31", help="Last day of history")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stages", default=",".join(STAGES), help=f"Comma-separated subset of {','.join(STAGES)}")
+    parser.add_argument("--repeat", type=int, default=20, help="Runs per timed stage")
+    parser.add_argument("--sample-products", type=int, default=5, help="Products trained and forecast")
+    parser.add_argument("--horizon", type=int, default=30, help="Forecast days per prediction")
+    parser.add_argument("--clean-products", type=int, default=200, help="Products in the raw export for cleaning")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Cleaning worker processes")
+    parser.add_argument("--requests", type=int, default=200, help="Timed /predict requests")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent /predict clients")
+    parser.add_argument("--port", type=int, default=8123, help="Port for the local Ray Serve instance")
+    parser.add_argument("--workdir", default=None, help="Directory for generated data and models (default: temporary)")
+    parser.add_argument("--generate", metavar="PATH", help="Only write the synthetic cleaned catalog to PATH and exit")
+    parser.add_argument("--output", default="benchmark_results.json", help="Where to write the results")
+    parser.add_argument("--baseline", help="Earlier results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE,
+                        help="Allowed slowdown before a stage counts as a regression")
+    args = parser.parse_args()
+    args.stages = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+    unknown = set(args.stages) - set(STAGES)
+    if unknown:
+        parser.error(f"Unknown stages: {', '.join(sorted(unknown))}")
+
+    started = time.perf_counter()
+    catalog = generate_catalog(args.products, args.days, seed=args.seed, end_date=args.end_date,
+                               sparse_fraction=args.sparse_fraction)
+    print(f"Generated {args.products} products x {args.days} days in {time.perf_counter() - started:.2f}s")
+    if args.generate:
+        catalog.to_csv(args.generate, index=False)
+        print(f"Catalog written to {args.generate}")
+        return
+
+    output = os.path.abspath(args.output)
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="demand-bench-"))
+    os.makedirs(workdir, exist_ok=True)
+    data_path = os.path.join(workdir, "cleaned_dataset.csv")
+    catalog.to_csv(data_path, index=False)
+    del catalog
+
+    # sarima.py reads its paths at import time and keeps models under ./models
+    env = {"DATA_PATH": data_path, "SNAPSHOT_PATH": os.path.join(workdir, "no_snapshot.parquet")}
+    os.environ.update(env)
+    os.chdir(workdir)
+    shutil.rmtree("models", ignore_errors=True)
+    sys.path.insert(0, REPO_DIR)
+    import sarima
+
+    stages = {}
+    sample = bench_service(args, sarima, stages)
+    if "cleaning" in args.stages:
+        bench_cleaning(args, workdir, stages)
+    if "serve" in args.stages:
+        bench_serve(args, env, sample, stages)
+
+    config = {key: getattr(args, key) for key in ("products", "days", "sparse_fraction", "seed", "repeat",
+                                                  "sample_products", "horizon", "clean_products", "workers",
+                                                  "requests", "concurrency")}
+    results = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "config": config,
+               "environment": environment(), "stages": stages}
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"Compared with {args.baseline} (tolerance {args.tolerance:.0%}):")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"❌ Regressions in: {', '.join(regressions)}")
+            exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,8 @@
+import os
+import json
+import shutil
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import pandas as pd
 import numpy as np
 
@@ -5,210 +10,624 @@ import numpy as np
 input_path = "/mnt/c/Users/lalit/OneDrive/Desktop/demand app/Cleaned_Complete_Ecommerce_Data.xlsx"
 output_path = "/mnt/c/Users/lalit/OneDrive/Desktop/demand app/cleaned_dataset.csv"
 
-# Reading the Excel file
-try:
-    df = pd.read_excel(input_path)
-except Exception as e:
-    print(f"❌ Failed to read Excel file: {e}")
-    exit(1)
+# Products are cleaned independently, so the catalog is split into chunks of this many
+# products and the chunks are spread over worker processes. Only a few chunks per worker
+# are in flight at a time and finished chunks are written out straight away, which keeps
+# peak memory bounded by the chunk size rather than the catalog size.
+CHUNK_PRODUCTS = 500
+CLEAN_WORKERS = os.cpu_count() or 1
+
+# Streaming mode (--stream) never holds the whole export in memory. Raw rows are read
+# READ_CHUNK_ROWS at a time and spilled into STREAM_BUCKETS files by a stable hash of
+# product_id, so every product lands whole in one bucket. Each bucket is then cleaned on
+# its own and written as one part of a partitioned Parquet dataset at the snapshot path,
+# which the forecasting service reads like the single-file snapshot. A manifest records
+# finished parts so a restarted run resumes after the last one.
+# It also keeps a content hash of every product's raw rows. With --incremental, a changed
+# source only re-cleans the products whose hash changed and splices them into their parts;
+# every feature, including Product_Popularity and Seasonality_Score, depends only on the
+# product's own rows, so nothing else needs recomputing.
+READ_CHUNK_ROWS = 100_000
+STREAM_BUCKETS = 64
+MANIFEST_NAME = "_manifest.json"
+SPILL_DIR_NAME = "_spill"
 
 # Define columns to keep, including additional features
 columns_to_keep = [
-    "product_id", "Date", "Sales Volume", "Opening Stock Level", "Reorder Point", 
-    "Lead Time (Days)", "Stock-out Date", "Remaining Stock Level", "selling_price", 
-    "Seasonality", "Revenue", "product_name", "category", "brand", "cost_price", 
-    "discount", "product_lifecycle", "supplier_name", "reliability_score", 
-    "Delivery_time", "defect_rate", "Purchase Frequency", "Customer_Purchase_Frequency", 
-    "Demand_Volatility", "Price_Elasticity", "Sales_Lag_60", "Sales_Lag_90", 
-    "Sales_Rolling_Mean_7", "Sales_Rolling_Std_7", "Sales_EMA_7", "Holiday", 
-    "Quarter", "shipping_method", "estimated_delivery_days", "delay_days", 
+    "product_id", "Date", "Sales Volume", "Opening Stock Level", "Reorder Point",
+    "Lead Time (Days)", "Stock-out Date", "Remaining Stock Level", "selling_price",
+    "Seasonality", "Revenue", "product_name", "category", "brand", "cost_price",
+    "discount", "product_lifecycle", "supplier_name", "reliability_score",
+    "Delivery_time", "defect_rate", "Purchase Frequency", "Customer_Purchase_Frequency",
+    "Demand_Volatility", "Price_Elasticity", "Sales_Lag_60", "Sales_Lag_90",
+    "Sales_Rolling_Mean_7", "Sales_Rolling_Std_7", "Sales_EMA_7", "Holiday",
+    "Quarter", "shipping_method", "estimated_delivery_days", "delay_days",
     "On-Time Delivery Rate (%)", "Order Fulfillment Time (Days)"
 ]
-# Filter columns that exist in the dataset
-columns_to_keep = [col for col in columns_to_keep if col in df.columns]
-df = df[columns_to_keep]
-
-# Debug: Check initial data
-print(f"Initial data shape: {df.shape}")
-print(f"Initial product IDs: {df['product_id'].unique()}")
-
-# Convert date columns to datetime
-df["Date"] = pd.to_datetime(df["Date"], errors="coerce")
-df["Stock-out Date"] = pd.to_datetime(df["Stock-out Date"], errors="coerce")
-
-# Debug: Check for invalid dates
-invalid_dates = df[df["Date"].isna()]
-if not invalid_dates.empty:
-    print(f"⚠️ Found {len(invalid_dates)} rows with invalid dates:")
-    print(invalid_dates[["product_id", "Date"]].to_string())
-
-# Impute invalid dates with the earliest date for each product
-if not invalid_dates.empty:
-    df["Date"] = df.groupby("product_id")["Date"].transform(lambda x: x.fillna(x.min()))
-    print(f"Imputed {len(invalid_dates)} invalid dates with product-specific earliest date.")
-
-# Debug: After handling invalid dates
-print(f"Data shape after handling invalid dates: {df.shape}")
 
 # Ensure numeric and non-negative values for key columns
 numeric_columns = [
-    "Sales Volume", "Opening Stock Level", "Remaining Stock Level", "Reorder Point", 
-    "Lead Time (Days)", "selling_price", "Revenue", "cost_price", "discount", 
-    "reliability_score", "Delivery_time", "defect_rate", "Purchase Frequency", 
-    "Customer_Purchase_Frequency", "Demand_Volatility", "Price_Elasticity", 
-    "Sales_Lag_60", "Sales_Lag_90", "Sales_Rolling_Mean_7", "Sales_Rolling_Std_7", 
-    "Sales_EMA_7", "estimated_delivery_days", "delay_days", "On-Time Delivery Rate (%)", 
+    "Sales Volume", "Opening Stock Level", "Remaining Stock Level", "Reorder Point",
+    "Lead Time (Days)", "selling_price", "Revenue", "cost_price", "discount",
+    "reliability_score", "Delivery_time", "defect_rate", "Purchase Frequency",
+    "Customer_Purchase_Frequency", "Demand_Volatility", "Price_Elasticity",
+    "Sales_Lag_60", "Sales_Lag_90", "Sales_Rolling_Mean_7", "Sales_Rolling_Std_7",
+    "Sales_EMA_7", "estimated_delivery_days", "delay_days", "On-Time Delivery Rate (%)",
     "Order Fulfillment Time (Days)"
 ]
-numeric_columns = [col for col in numeric_columns if col in df.columns]
-for col in numeric_columns:
-    df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0)
-    df[col] = df[col].clip(lower=0)  # Ensure non-negative values without dropping rows
-
-# Debug: After ensuring non-negative values
-print(f"Data shape after ensuring non-negative values: {df.shape}")
-
-# Validate Remaining Stock Level <= Opening Stock Level
-invalid_stock_rows = df[df["Remaining Stock Level"] > df["Opening Stock Level"]]
-if not invalid_stock_rows.empty:
-    print(f"⚠️ Warning: Found {len(invalid_stock_rows)} rows where Remaining Stock Level > Opening Stock Level:")
-    print(invalid_stock_rows[["product_id", "Date", "Opening Stock Level", "Remaining Stock Level"]].to_string())
-    df.loc[df["Remaining Stock Level"] > df["Opening Stock Level"], "Remaining Stock Level"] = df["Opening Stock Level"]
-
-# Resample data to daily frequency for each product
-df_list = []
-for product_id in df["product_id"].unique():
-    product_df = df[df["product_id"] == product_id].set_index("Date")
-    product_df = product_df.resample("D").asfreq().fillna(method="ffill").reset_index()
-    df_list.append(product_df)
-
-# Concatenate resampled data
-df = pd.concat(df_list, ignore_index=True)
-
-# Debug: After resampling
-print(f"Data shape after resampling: {df.shape}")
-
-# Sort by product_id and Date
-df = df.sort_values(by=["product_id", "Date"])
-
-# Add demand and inventory-related features
-df["Sales_Lag_7"] = df.groupby("product_id")["Sales Volume"].shift(7)
-df["Sales_Lag_30"] = df.groupby("product_id")["Sales Volume"].shift(30)
-df["Rolling_Sales_7"] = df.groupby("product_id")["Sales Volume"].transform(lambda x: x.shift(1).rolling(7).mean())
-df["Rolling_Sales_30"] = df.groupby("product_id")["Sales Volume"].transform(lambda x: x.shift(1).rolling(30).mean())
-df["Sales_Diff_1"] = df.groupby("product_id")["Sales Volume"].diff(1)
-
-# Avoid division by zero
-df["Stock_Turnover"] = df["Sales Volume"] / df["Opening Stock Level"].replace(0, np.nan)
-df["Stock_Turnover"] = df["Stock_Turnover"].fillna(0)
-
-# Days until stockout
-df["Days_Until_Stockout"] = df["Remaining Stock Level"] / df["Sales Volume"].replace(0, np.nan)
-df["Days_Until_Stockout"] = df["Days_Until_Stockout"].fillna(np.inf)
-
-# Flags
-df["Is_Stockout"] = (df["Remaining Stock Level"] == 0).astype(int)
-df["Is_Reorder_Triggered"] = (df["Opening Stock Level"] <= df["Reorder Point"]).astype(int)
-
-# Calendar features
-df["Day_of_Week"] = df["Date"].dt.dayofweek
-df["Week_of_Year"] = df["Date"].dt.isocalendar().week
-df["Month"] = df["Date"].dt.month
-df["Is_Weekend"] = df["Day_of_Week"].isin([5, 6]).astype(int)
-
-# Product-level feature: total popularity
-product_popularity = df.groupby("product_id")["Sales Volume"].sum().rename("Product_Popularity")
-df = df.merge(product_popularity, on="product_id", how="left")
-
-# Compute average sales per weekday per product (weekly seasonality)
-seasonality = df.groupby(["product_id", "Day_of_Week"])["Sales Volume"].mean().reset_index()
-seasonality.columns = ["product_id", "Day_of_Week", "Seasonality_Score"]
-df = df.merge(seasonality, on=["product_id", "Day_of_Week"], how="left")
-
-# Additional feature: Profit margin
-if "selling_price" in df.columns and "cost_price" in df.columns:
-    df["Profit_Margin"] = (df["selling_price"] - df["cost_price"]) / df["selling_price"].replace(0, np.nan)
-    df["Profit_Margin"] = df["Profit_Margin"].fillna(0)
-
-# Additional feature: Discount rate
-if "discount" in df.columns and "selling_price" in df.columns:
-    df["Discount_Rate"] = df["discount"] / df["selling_price"].replace(0, np.nan)
-    df["Discount_Rate"] = df["Discount_Rate"].fillna(0)
-
-# --- Handle NaN and Inf Values ---
-
-# 1. Identify columns with NaN or Inf
-print("Columns with NaN values before imputation:")
-print(df.isna().sum())
-print("\nColumns with Inf values before imputation:")
-print(df.select_dtypes(include=[np.number]).apply(lambda x: np.isinf(x)).sum())
-
-# 2. Impute NaN in lag and rolling features with product-specific mean
+
+# Lag and rolling features are imputed with the product mean
 lag_rolling_cols = ["Sales_Lag_7", "Sales_Lag_30", "Rolling_Sales_7", "Rolling_Sales_30", "Sales_Diff_1"]
-for col in lag_rolling_cols:
-    if col in df.columns:
-        df[col] = df.groupby("product_id")[col].transform(lambda x: x.fillna(x.mean()))
-        # If mean is still NaN (e.g., all values are NaN), fill with 0
-        df[col] = df[col].fillna(0)
-
-# 3. Handle NaN and Inf in Stock_Turnover and Days_Until_Stockout
-df["Stock_Turnover"] = df["Stock_Turnover"].replace([np.inf, -np.inf], 0).fillna(0)
-df["Days_Until_Stockout"] = df["Days_Until_Stockout"].replace([np.inf, -np.inf], 1e6).fillna(1e6)
-
-# 4. Handle NaN in Profit_Margin and Discount_Rate
-if "Profit_Margin" in df.columns:
-    df["Profit_Margin"] = df["Profit_Margin"].replace([np.inf, -np.inf], 0).fillna(0)
-if "Discount_Rate" in df.columns:
-    df["Discount_Rate"] = df["Discount_Rate"].replace([np.inf, -np.inf], 0).fillna(0)
-
-# 5. Impute NaN in other numeric features with product-specific median
-numeric_cols = [
-    "Demand_Volatility", "Price_Elasticity", "Sales_Lag_60", "Sales_Lag_90", 
-    "Sales_Rolling_Mean_7", "Sales_Rolling_Std_7", "Sales_EMA_7", 
-    "estimated_delivery_days", "delay_days", "On-Time Delivery Rate (%)", 
+
+# Other numeric features are imputed with the product median
+median_cols = [
+    "Demand_Volatility", "Price_Elasticity", "Sales_Lag_60", "Sales_Lag_90",
+    "Sales_Rolling_Mean_7", "Sales_Rolling_Std_7", "Sales_EMA_7",
+    "estimated_delivery_days", "delay_days", "On-Time Delivery Rate (%)",
     "Order Fulfillment Time (Days)"
 ]
-numeric_cols = [col for col in numeric_cols if col in df.columns]
-for col in numeric_cols:
-    df[col] = df.groupby("product_id")[col].transform(lambda x: x.fillna(x.median()))
-    df[col] = df[col].fillna(0)  # Fallback to 0 if median is NaN
-
-# 6. Forward-fill and backward-fill for time-series features like Seasonality_Score
-if "Seasonality_Score" in df.columns:
-    df["Seasonality_Score"] = df.groupby("product_id")["Seasonality_Score"].fillna(method="ffill").fillna(method="bfill")
-    df["Seasonality_Score"] = df["Seasonality_Score"].fillna(0)  # Fallback if all values are NaN
 
-# 7. Handle categorical columns
 categorical_cols = ["category", "brand", "supplier_name", "shipping_method", "product_name", "product_lifecycle"]
-categorical_cols = [col for col in categorical_cols if col in df.columns]
-for col in categorical_cols:
-    df[col] = df[col].fillna("Unknown")
-
-# 8. Verify no NaN or Inf remains
-print("\nColumns with NaN values after imputation:")
-print(df.isna().sum())
-print("\nColumns with Inf values after imputation:")
-print(df.select_dtypes(include=[np.number]).apply(lambda x: np.isinf(x)).sum())
 
-# Validate data sufficiency per product
 min_data_points = 365  # Ensure exactly 365 days per product
-product_counts = df.groupby("product_id").size()
-valid_products = product_counts[product_counts == min_data_points].index
-df = df[df["product_id"].isin(valid_products)]
-
-# Debug: Check data for specific date range
-date_range_data = df[(df["Date"] >= "2024-04-22") & (df["Date"] <= "2024-04-29")]
-if date_range_data.empty:
-    print("⚠️ No data found in the range 2024-04-22 to 2024-04-29.")
-else:
-    print(f"Data in range 2024-04-22 to 2024-04-29:\n{date_range_data.head().to_string()}")
-
-if df.empty:
-    print("❌ No products have sufficient data points (exactly 365).")
-    exit(1)
-
-# Save the cleaned dataset
-df.to_csv(output_path, index=False)
-print(f"✅ Cleaned data with additional features saved as '{output_path}'")
-print(f"Number of valid products: {len(valid_products)}")
-print(f"Sample data:\n{df.head().to_string()}")
\ No newline at end of file
+
+
+def read_raw(path):
+    # Only the columns we keep are parsed; the export carries many more
+    wanted = set(columns_to_keep)
+    if path.lower().endswith(".csv"):
+        return pd.read_csv(path, usecols=lambda col: col in wanted)
+    return pd.read_excel(path, usecols=lambda col: col in wanted)
+
+
+def prepare_raw(df):
+    # Filter columns that exist in the dataset
+    df = df[[col for col in columns_to_keep if col in df.columns]].copy()
+
+    # Convert date columns to datetime
+    df["Date"] = pd.to_datetime(df["Date"], errors="coerce")
+    df["Stock-out Date"] = pd.to_datetime(df["Stock-out Date"], errors="coerce")
+
+    # Impute invalid dates with the earliest date for each product
+    invalid_dates = df["Date"].isna()
+    if invalid_dates.any():
+        print(f"⚠️ Found {int(invalid_dates.sum())} rows with invalid dates:")
+        print(df.loc[invalid_dates, ["product_id", "Date"]].to_string())
+        df["Date"] = df["Date"].fillna(df.groupby("product_id")["Date"].transform("min"))
+        print(f"Imputed {int(invalid_dates.sum())} invalid dates with product-specific earliest date.")
+
+    for col in [col for col in numeric_columns if col in df.columns]:
+        df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0).clip(lower=0)
+
+    # Validate Remaining Stock Level <= Opening Stock Level
+    invalid_stock = df["Remaining Stock Level"] > df["Opening Stock Level"]
+    if invalid_stock.any():
+        print(f"⚠️ Warning: Found {int(invalid_stock.sum())} rows where Remaining Stock Level > Opening Stock Level")
+        df.loc[invalid_stock, "Remaining Stock Level"] = df.loc[invalid_stock, "Opening Stock Level"]
+
+    # Stable sort so every product is one contiguous block, in original row order
+    return df.sort_values("product_id", kind="stable").reset_index(drop=True)
+
+
+def resample_daily(df):
+    # Build the full (product, day) grid from each product's first to last date in one go
+    # and reindex against it, instead of resampling product by product. Imputed dates can
+    # collide with a real row for the same day, which the reindex cannot take, so the
+    # first row per day wins.
+    df = df.drop_duplicates(["product_id", "Date"], keep="first")
+    bounds = df.groupby("product_id", sort=False)["Date"].agg(["min", "max"])
+    lengths = ((bounds["max"] - bounds["min"]).dt.days + 1).to_numpy()
+    starts = np.repeat(bounds["min"].to_numpy(), lengths)
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    grid = pd.MultiIndex.from_arrays(
+        [np.repeat(bounds.index.to_numpy(), lengths), starts + offsets.astype("timedelta64[D]")],
+        names=["product_id", "Date"],
+    )
+    df = df.set_index(["product_id", "Date"]).reindex(grid)
+    df = df.groupby(level="product_id", sort=False).ffill()
+    df = df.reset_index()
+    columns = ["Date", "product_id"] + [col for col in df.columns if col not in ("Date", "product_id")]
+    return df[columns]
+
+
+def add_features(df):
+    df = df.sort_values(by=["product_id", "Date"], kind="stable").reset_index(drop=True)
+    sales = df.groupby("product_id", sort=False)["Sales Volume"]
+
+    # Add demand and inventory-related features
+    df["Sales_Lag_7"] = sales.shift(7)
+    df["Sales_Lag_30"] = sales.shift(30)
+    previous = sales.shift(1).groupby(df["product_id"], sort=False)
+    df["Rolling_Sales_7"] = previous.rolling(7).mean().droplevel(0)
+    df["Rolling_Sales_30"] = previous.rolling(30).mean().droplevel(0)
+    df["Sales_Diff_1"] = sales.diff(1)
+
+    # Avoid division by zero
+    df["Stock_Turnover"] = (df["Sales Volume"] / df["Opening Stock Level"].replace(0, np.nan)).fillna(0)
+
+    # Days until stockout
+    df["Days_Until_Stockout"] = (df["Remaining Stock Level"] / df["Sales Volume"].replace(0, np.nan)).fillna(np.inf)
+
+    # Flags
+    df["Is_Stockout"] = (df["Remaining Stock Level"] == 0).astype(int)
+    df["Is_Reorder_Triggered"] = (df["Opening Stock Level"] <= df["Reorder Point"]).astype(int)
+
+    # Calendar features
+    df["Day_of_Week"] = df["Date"].dt.dayofweek
+    df["Week_of_Year"] = df["Date"].dt.isocalendar().week
+    df["Month"] = df["Date"].dt.month
+    df["Is_Weekend"] = df["Day_of_Week"].isin([5, 6]).astype(int)
+
+    # Product-level feature: total popularity
+    df["Product_Popularity"] = sales.transform("sum")
+
+    # Average sales per weekday per product (weekly seasonality)
+    df["Seasonality_Score"] = df.groupby(["product_id", "Day_of_Week"], sort=False)["Sales Volume"].transform("mean")
+
+    # Additional feature: Profit margin
+    if "selling_price" in df.columns and "cost_price" in df.columns:
+        df["Profit_Margin"] = (df["selling_price"] - df["cost_price"]) / df["selling_price"].replace(0, np.nan)
+        df["Profit_Margin"] = df["Profit_Margin"].fillna(0)
+
+    # Additional feature: Discount rate
+    if "discount" in df.columns and "selling_price" in df.columns:
+        df["Discount_Rate"] = df["discount"] / df["selling_price"].replace(0, np.nan)
+        df["Discount_Rate"] = df["Discount_Rate"].fillna(0)
+    return df
+
+
+def impute(df):
+    groups = df.groupby("product_id", sort=False)
+
+    # Impute NaN in lag and rolling features with product-specific mean, falling back to 0
+    for col in [col for col in lag_rolling_cols if col in df.columns]:
+        df[col] = df[col].fillna(groups[col].transform("mean")).fillna(0)
+
+    # Handle NaN and Inf in Stock_Turnover and Days_Until_Stockout
+    df["Stock_Turnover"] = df["Stock_Turnover"].replace([np.inf, -np.inf], 0).fillna(0)
+    df["Days_Until_Stockout"] = df["Days_Until_Stockout"].replace([np.inf, -np.inf], 1e6).fillna(1e6)
+
+    # Handle NaN in Profit_Margin and Discount_Rate
+    for col in ["Profit_Margin", "Discount_Rate"]:
+        if col in df.columns:
+            df[col] = df[col].replace([np.inf, -np.inf], 0).fillna(0)
+
+    # Impute NaN in other numeric features with product-specific median, falling back to 0
+    for col in [col for col in median_cols if col in df.columns]:
+        df[col] = df[col].fillna(groups[col].transform("median")).fillna(0)
+
+    # Forward-fill and backward-fill Seasonality_Score within each product
+    if "Seasonality_Score" in df.columns:
+        df["Seasonality_Score"] = groups["Seasonality_Score"].ffill()
+        df["Seasonality_Score"] = df["Seasonality_Score"].fillna(
+            df.groupby("product_id", sort=False)["Seasonality_Score"].bfill()
+        ).fillna(0)
+
+    # Handle categorical columns
+    for col in [col for col in categorical_cols if col in df.columns]:
+        df[col] = df[col].fillna("Unknown")
+    return df
+
+
+def missing_counts(df):
+    numeric = df.select_dtypes(include=[np.number])
+    return df.isna().sum(), pd.Series(np.isinf(numeric.to_numpy(dtype=float)).sum(axis=0), index=numeric.columns)
+
+
+def clean_chunk(raw, csv=True):
+    # Runs in a worker process on a contiguous block of whole products
+    df = add_features(resample_daily(raw))
+    nan_before, inf_before = missing_counts(df)
+    df = impute(df)
+    nan_after, inf_after = missing_counts(df)
+
+    # Validate data sufficiency per product
+    product_counts = df.groupby("product_id", sort=False).size()
+    valid_products = product_counts[product_counts == min_data_points].index
+    df = df[df["product_id"].isin(valid_products)].reset_index(drop=True)
+    stats = {
+        "rows_resampled": int(product_counts.sum()),
+        "nan_before": nan_before, "inf_before": inf_before,
+        "nan_after": nan_after, "inf_after": inf_after,
+        "valid_products": len(valid_products),
+        # Formatting floats dominates the CSV write, so it is done here in the worker
+        "csv": df.to_csv(index=False, header=False) if csv else None,
+    }
+    return df, stats
+
+
+def product_chunks(df, chunk_products):
+    # df is sorted by product_id, so each chunk is a contiguous slice and no product is
+    # ever filtered out of the whole frame
+    product_ids = df["product_id"].to_numpy()
+    starts = np.flatnonzero(np.r_[True, product_ids[1:] != product_ids[:-1]])
+    bounds = np.r_[starts[::chunk_products], len(df)]
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        yield df.iloc[lo:hi]
+
+
+def run_chunks(df, workers, chunk_products):
+    chunks = product_chunks(df, chunk_products)
+    if workers <= 1:
+        for chunk in chunks:
+            yield clean_chunk(chunk)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Bounded window of submitted chunks; results come back in catalog order
+        pending = []
+        for chunk in chunks:
+            pending.append(executor.submit(clean_chunk, chunk))
+            if len(pending) >= 2 * workers:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+
+class SnapshotWriter:
+    # Streams cleaned chunks into the CSV and the Parquet snapshot as they finish
+    def __init__(self, csv_path):
+        self.csv_path = csv_path
+        self.csv_tmp = csv_path + ".tmp"
+        self.snapshot_path = os.path.splitext(csv_path)[0] + ".parquet"
+        self.snapshot_tmp = self.snapshot_path + ".tmp"
+        self.parquet = None
+        self.schema = None
+        self.rows = 0
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            self.pa, self.pq = pa, pq
+        except ImportError as e:
+            print(f"⚠️ Skipping Parquet snapshot, no Parquet engine installed: {e}")
+            self.pa = self.pq = None
+
+    def write(self, df, csv_text):
+        if df.empty:
+            return
+        with open(self.csv_tmp, "w" if self.rows == 0 else "a", newline="") as f:
+            if self.rows == 0:
+                f.write(df.head(0).to_csv(index=False))
+            f.write(csv_text)
+        if self.pa is not None:
+            if self.parquet is None:
+                table = self.pa.Table.from_pandas(df, preserve_index=False)
+                self.schema = table.schema
+                self.parquet = self.pq.ParquetWriter(self.snapshot_tmp, self.schema)
+            else:
+                table = self.pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+            self.parquet.write_table(table)
+        self.rows += len(df)
+
+    def close(self):
+        if self.parquet is not None:
+            self.parquet.close()
+        if self.rows == 0:
+            return False
+        os.replace(self.csv_tmp, self.csv_path)
+        print(f"✅ Cleaned data with additional features saved as '{self.csv_path}'")
+        if self.parquet is not None:
+            if os.path.isdir(self.snapshot_path):
+                # Left behind by a streaming run
+                shutil.rmtree(self.snapshot_path)
+            os.replace(self.snapshot_tmp, self.snapshot_path)
+            print(f"✅ Columnar snapshot saved as '{self.snapshot_path}'")
+        return True
+
+
+def iter_raw_chunks(path, chunksize):
+    wanted = set(columns_to_keep)
+    if path.lower().endswith(".csv"):
+        # Kept as text so spilled rows and product hashes don't depend on how pandas
+        # happened to infer each chunk's dtypes
+        yield from pd.read_csv(path, usecols=lambda col: col in wanted, chunksize=chunksize, dtype=str)
+        return
+    # pd.read_excel has no chunked mode, so walk the first sheet row by row instead
+    from openpyxl import load_workbook
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None) or ()
+        keep = [i for i, col in enumerate(header) if col in wanted]
+        columns = [header[i] for i in keep]
+        batch = []
+        for row in rows:
+            batch.append([row[i] if i < len(row) else None for i in keep])
+            if len(batch) >= chunksize:
+                yield pd.DataFrame(batch, columns=columns)
+                batch = []
+        if batch:
+            yield pd.DataFrame(batch, columns=columns)
+    finally:
+        workbook.close()
+
+
+def source_signature(path):
+    stat = os.stat(path)
+    return {"source": os.path.abspath(path), "size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def read_manifest(dataset_dir):
+    try:
+        with open(os.path.join(dataset_dir, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def write_manifest(dataset_dir, manifest):
+    path = os.path.join(dataset_dir, MANIFEST_NAME)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def bucket_path(dataset_dir, bucket):
+    return os.path.join(dataset_dir, SPILL_DIR_NAME, f"bucket-{bucket:04d}.csv")
+
+
+def part_path(dataset_dir, bucket):
+    return os.path.join(dataset_dir, f"part-{bucket:04d}.parquet")
+
+
+def bucket_of(product_ids, buckets):
+    return pd.util.hash_pandas_object(pd.Series(product_ids, dtype=str), index=False).to_numpy() % buckets
+
+
+def spill_buckets(source, dataset_dir, buckets, chunksize):
+    # Hash-partition the raw rows by product so each bucket can be cleaned on its own.
+    # Also returns a content hash per product: the wrapping uint64 sum of its row hashes
+    # plus the row count, so it doesn't depend on where in the export the rows sit.
+    spill_dir = os.path.join(dataset_dir, SPILL_DIR_NAME)
+    shutil.rmtree(spill_dir, ignore_errors=True)
+    os.makedirs(spill_dir)
+    columns = None
+    rows = 0
+    sums = {}
+    counts = {}
+    for chunk in iter_raw_chunks(source, chunksize):
+        if columns is None:
+            columns = [col for col in columns_to_keep if col in chunk.columns]
+        chunk = chunk.reindex(columns=columns)
+        chunk["product_id"] = chunk["product_id"].astype(str)
+
+        codes, uniques = pd.factorize(chunk["product_id"])
+        row_hashes = pd.util.hash_pandas_object(chunk.astype(str), index=False).to_numpy()
+        chunk_sums = np.zeros(len(uniques), dtype=np.uint64)
+        np.add.at(chunk_sums, codes, row_hashes)
+        chunk_counts = np.bincount(codes, minlength=len(uniques))
+        for pid, total, count in zip(uniques, chunk_sums, chunk_counts):
+            # Python ints masked to 64 bits wrap like the uint64 sums, without overflow warnings
+            sums[pid] = (sums.get(pid, 0) + int(total)) & 0xFFFFFFFFFFFFFFFF
+            counts[pid] = counts.get(pid, 0) + int(count)
+
+        bucket_ids = bucket_of(chunk["product_id"], buckets)
+        for bucket, rows_in_bucket in chunk.groupby(bucket_ids, sort=False):
+            path = bucket_path(dataset_dir, int(bucket))
+            rows_in_bucket.to_csv(path, mode="a", header=not os.path.exists(path), index=False)
+        rows += len(chunk)
+        print(f"Spilled {rows} raw rows into {buckets} buckets")
+    hashes = {pid: f"{int(sums[pid]):016x}:{counts[pid]}" for pid in sums}
+    return rows, hashes
+
+
+def clean_bucket(spill, part):
+    # Runs in a worker process: one bucket in, one Parquet part out
+    if not os.path.exists(spill):
+        return {"rows": 0, "valid_products": 0}
+    df = prepare_raw(pd.read_csv(spill, dtype={"product_id": str}))
+    cleaned = []
+    valid_products = 0
+    for chunk in product_chunks(df, CHUNK_PRODUCTS):
+        chunk, stats = clean_chunk(chunk, csv=False)
+        cleaned.append(chunk)
+        valid_products += stats["valid_products"]
+    df = pd.concat(cleaned, ignore_index=True)
+    if df.empty:
+        return {"rows": 0, "valid_products": 0}
+    # Passthrough integer columns become float64 so every part shares one schema even
+    # when a bucket happened to have missing values in them
+    for col in df.columns:
+        if col in columns_to_keep and pd.api.types.is_integer_dtype(df[col]):
+            df[col] = df[col].astype("float64")
+    # Leading dot keeps the partial file out of the dataset until it is complete
+    tmp = os.path.join(os.path.dirname(part), "." + os.path.basename(part) + ".tmp")
+    df.to_parquet(tmp, index=False)
+    os.replace(tmp, part)
+    return {"rows": len(df), "valid_products": valid_products}
+
+
+def splice_bucket(spill, part, product_ids):
+    # Runs in a worker process: re-cleans only the given products of one bucket and
+    # swaps their rows in the existing part, leaving every other product untouched
+    kept = pd.read_parquet(part) if os.path.exists(part) else pd.DataFrame()
+    if not kept.empty:
+        kept = kept[~kept["product_id"].isin(product_ids)]
+    fresh = pd.DataFrame()
+    if os.path.exists(spill):
+        raw = pd.read_csv(spill, dtype={"product_id": str})
+        raw = raw[raw["product_id"].isin(product_ids)]
+        if not raw.empty:
+            fresh, _ = clean_chunk(prepare_raw(raw), csv=False)
+            for col in fresh.columns:
+                if col in columns_to_keep and pd.api.types.is_integer_dtype(fresh[col]):
+                    fresh[col] = fresh[col].astype("float64")
+            if not kept.empty:
+                fresh = fresh.astype(kept.dtypes.to_dict())
+    frames = [frame for frame in (kept, fresh) if not frame.empty]
+    if not frames:
+        if os.path.exists(part):
+            os.remove(part)
+        return {"rows": 0, "valid_products": 0}
+    df = pd.concat(frames, ignore_index=True)
+    tmp = os.path.join(os.path.dirname(part), "." + os.path.basename(part) + ".tmp")
+    df.to_parquet(tmp, index=False)
+    os.replace(tmp, part)
+    return {"rows": len(df), "valid_products": int(df["product_id"].nunique())}
+
+
+def plan_incremental(dataset_dir, manifest, signature, args):
+    # Re-spill the new source and compare product hashes with the finished run. Only
+    # buckets holding a changed, added or removed product are queued again, each with
+    # the products it has to splice.
+    raw_rows, hashes = spill_buckets(args.input, dataset_dir, args.buckets, args.read_chunksize)
+    previous = manifest["products"]
+    changed = sorted(pid for pid in set(previous) | set(hashes) if previous.get(pid) != hashes.get(pid))
+    splices = {}
+    for pid, bucket in zip(changed, bucket_of(changed, args.buckets)):
+        splices.setdefault(str(int(bucket)), []).append(pid)
+    print(f"Incremental refresh: {len(changed)} of {len(hashes)} products changed, "
+          f"{len(splices)}/{args.buckets} parts to update")
+    manifest.update({
+        "signature": signature, "spilled": True, "complete": False, "raw_rows": raw_rows,
+        "products": hashes, "splices": splices,
+        "parts": {bucket: stats for bucket, stats in manifest["parts"].items() if bucket not in splices},
+    })
+    write_manifest(dataset_dir, manifest)
+
+
+def run_stream(args):
+    dataset_dir = os.path.splitext(args.output)[0] + ".parquet"
+    signature = source_signature(args.input)
+    manifest = read_manifest(dataset_dir) if os.path.isdir(dataset_dir) else None
+    can_splice = (args.incremental and manifest is not None and manifest.get("complete")
+                  and manifest.get("buckets") == args.buckets and "products" in manifest)
+    if can_splice and manifest["signature"] != signature:
+        plan_incremental(dataset_dir, manifest, signature, args)
+    elif manifest is None or manifest.get("signature") != signature or manifest.get("buckets") != args.buckets:
+        # New or changed source: start over
+        if os.path.isdir(dataset_dir):
+            shutil.rmtree(dataset_dir)
+        elif os.path.exists(dataset_dir):
+            os.remove(dataset_dir)
+        os.makedirs(dataset_dir)
+        manifest = {"signature": signature, "buckets": args.buckets, "spilled": False, "parts": {}}
+        write_manifest(dataset_dir, manifest)
+    elif manifest.get("complete"):
+        print(f"✅ '{dataset_dir}' is already up to date with '{args.input}'")
+        return
+
+    if not manifest["spilled"]:
+        manifest["raw_rows"], manifest["products"] = spill_buckets(
+            args.input, dataset_dir, args.buckets, args.read_chunksize)
+        manifest["spilled"] = True
+        write_manifest(dataset_dir, manifest)
+    elif manifest.get("splices") is None:
+        print(f"Resuming: {len(manifest['parts'])}/{args.buckets} parts already written")
+
+    # An incremental run splices its queued buckets; splicing the same products twice
+    # after a crash gives the same part, so resuming one is safe too
+    splices = manifest.get("splices") or {}
+    pending = [bucket for bucket in range(args.buckets) if str(bucket) not in manifest["parts"]]
+    with ProcessPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        futures = {}
+        for bucket in pending:
+            spill, part = bucket_path(dataset_dir, bucket), part_path(dataset_dir, bucket)
+            if str(bucket) in splices:
+                future = executor.submit(splice_bucket, spill, part, splices[str(bucket)])
+            else:
+                future = executor.submit(clean_bucket, spill, part)
+            futures[future] = bucket
+        for future in as_completed(futures):
+            bucket = futures[future]
+            stats = future.result()
+            manifest["parts"][str(bucket)] = stats
+            write_manifest(dataset_dir, manifest)
+            print(f"Part {bucket:04d}: {stats['rows']} rows, {stats['valid_products']} valid products "
+                  f"({len(manifest['parts'])}/{args.buckets} done)")
+
+    shutil.rmtree(os.path.join(dataset_dir, SPILL_DIR_NAME), ignore_errors=True)
+    manifest["complete"] = True
+    manifest.pop("splices", None)
+    write_manifest(dataset_dir, manifest)
+    rows = sum(part["rows"] for part in manifest["parts"].values())
+    valid_products = sum(part["valid_products"] for part in manifest["parts"].values())
+    if rows == 0:
+        print("❌ No products have sufficient data points (exactly 365).")
+        exit(1)
+    print(f"✅ Cleaned data with additional features saved as partitioned snapshot '{dataset_dir}'")
+    print(f"Number of valid products: {valid_products}, rows: {rows}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Clean the raw e-commerce export into the daily dataset")
+    parser.add_argument("--input", default=input_path, help="Raw Excel or CSV export")
+    parser.add_argument("--output", default=output_path, help="Cleaned CSV; the Parquet snapshot is written next to it")
+    parser.add_argument("--workers", type=int, default=CLEAN_WORKERS, help="Worker processes for product chunks")
+    parser.add_argument("--chunk-products", type=int, default=CHUNK_PRODUCTS, help="Products per chunk")
+    parser.add_argument("--stream", action="store_true",
+                        help="Read the export in chunks and write a resumable partitioned Parquet snapshot")
+    parser.add_argument("--buckets", type=int, default=STREAM_BUCKETS, help="Output partitions in streaming mode")
+    parser.add_argument("--read-chunksize", type=int, default=READ_CHUNK_ROWS, help="Raw rows per read in streaming mode")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Streaming mode: re-clean only products whose raw rows changed since the last run")
+    args = parser.parse_args()
+
+    if args.stream or args.incremental:
+        run_stream(args)
+        return
+
+    # Reading the Excel file
+    try:
+        df = read_raw(args.input)
+    except Exception as e:
+        print(f"❌ Failed to read Excel file: {e}")
+        exit(1)
+
+    # Debug: Check initial data
+    print(f"Initial data shape: {df.shape}")
+    print(f"Initial product IDs: {df['product_id'].nunique()} unique")
+
+    df = prepare_raw(df)
+    print(f"Data shape after ensuring non-negative values: {df.shape}")
+
+    writer = SnapshotWriter(args.output)
+    rows_resampled = 0
+    valid_products = 0
+    nan_before = inf_before = nan_after = inf_after = None
+    sample = None
+    range_sample = None
+    for cleaned, stats in run_chunks(df, max(1, args.workers), max(1, args.chunk_products)):
+        writer.write(cleaned, stats.pop("csv"))
+        rows_resampled += stats["rows_resampled"]
+        valid_products += stats["valid_products"]
+        nan_before = stats["nan_before"] if nan_before is None else nan_before.add(stats["nan_before"], fill_value=0)
+        inf_before = stats["inf_before"] if inf_before is None else inf_before.add(stats["inf_before"], fill_value=0)
+        nan_after = stats["nan_after"] if nan_after is None else nan_after.add(stats["nan_after"], fill_value=0)
+        inf_after = stats["inf_after"] if inf_after is None else inf_after.add(stats["inf_after"], fill_value=0)
+        if sample is None and not cleaned.empty:
+            sample = cleaned.head()
+        if range_sample is None:
+            in_range = cleaned[(cleaned["Date"] >= "2024-04-22") & (cleaned["Date"] <= "2024-04-29")]
+            if not in_range.empty:
+                range_sample = in_range.head()
+    del df
+
+    # Debug: After resampling
+    print(f"Data shape after resampling: ({rows_resampled}, {len(nan_before) if nan_before is not None else 0})")
+    if nan_before is not None:
+        print("Columns with NaN values before imputation:")
+        print(nan_before.astype(int))
+        print("\nColumns with Inf values before imputation:")
+        print(inf_before.astype(int))
+        print("\nColumns with NaN values after imputation:")
+        print(nan_after.astype(int))
+        print("\nColumns with Inf values after imputation:")
+        print(inf_after.astype(int))
+
+    # Debug: Check data for specific date range
+    if range_sample is None:
+        print("⚠️ No data found in the range 2024-04-22 to 2024-04-29.")
+    else:
+        print(f"Data in range 2024-04-22 to 2024-04-29:\n{range_sample.to_string()}")
+
+    if not writer.close():
+        print("❌ No products have sufficient data points (exactly 365).")
+        exit(1)
+    print(f"Number of valid products: {valid_products}")
+    print(f"Sample data:\n{sample.to_string()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,30 +5,285 @@ import pandas as pd
 import numpy as np
 import matplotlib
 matplotlib.use("Agg")
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import ray
 from ray import serve
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from statsmodels.tsa.statespace.sarimax import SARIMAX
 from statsmodels.tools.sm_exceptions import ConvergenceWarning
-from pmdarima import auto_arima
 import joblib
+import json
+import csv
+import gzip
+import shutil
+import time
+import argparse
+import asyncio
+import threading
+import uuid
+import heapq
+import itertools
+import functools
+from collections import OrderedDict, Counter
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import sys
 import logging
 import warnings
+from prometheus_client import CollectorRegistry, Counter as MetricCounter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+try:
+    import fcntl
+except ImportError:  # Windows: file locks are only per process
+    fcntl = None
+# Optional response encoders; formats whose package is missing aren't offered
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
 from pydantic import BaseModel
 from datetime import datetime
 
 # Setup paths
-DATA_PATH = "/mnt/c/Users/lalit/OneDrive/Desktop/demand app/cleaned_dataset.csv"
+DATA_PATH = os.environ.get("DATA_PATH", "/mnt/c/Users/lalit/OneDrive/Desktop/demand app/cleaned_dataset.csv")
+# Columnar snapshot written by dataset_cleaning.py; preferred over the CSV
+# unless the CSV is newer. Either a single file or, from dataset_cleaning.py
+# --stream, a directory of parts. Rows an ingestion log compaction folds
+# into the CSV also go to INGESTED_PATH, tagged with the snapshot they
+# extend, so the snapshot plus those rows stays current after a compaction.
+SNAPSHOT_PATH = os.environ.get("SNAPSHOT_PATH", os.path.splitext(DATA_PATH)[0] + ".parquet")
+INGESTED_PATH = os.path.splitext(SNAPSHOT_PATH)[0] + ".ingested.parquet"
 MODEL_DIR = "models"
+TRAINING_REPORT_PATH = os.path.join(MODEL_DIR, "training_report.json")
+BULK_JOB_DIR = os.path.join(MODEL_DIR, "bulk_jobs")
+BACKTEST_REPORT_PATH = os.path.join(MODEL_DIR, "backtest_report.json")
+REGISTRY_PATH = os.path.join(MODEL_DIR, "registry.jsonl")
+ORDER_CACHE_PATH = os.path.join(MODEL_DIR, "order_cache.jsonl")
+TRAINING_LOCK_DIR = os.path.join(MODEL_DIR, "locks")
+INGEST_LOG_PATH = DATA_PATH + ".wal"
+CHECKPOINT_PATH = DATA_PATH + ".checkpoint"
+
+# Days of sample kept in a compact model artifact
+MODEL_TAIL_DAYS = int(os.environ.get("MODEL_TAIL_DAYS", 28))
+
+# Incremental model updates: new observations are filtered into the existing
+# fit; a full order search + refit only happens every FULL_REFIT_EVERY updates
+# or when the MAE on appended data exceeds DRIFT_THRESHOLD x the in-sample MAE.
+FULL_REFIT_EVERY = int(os.environ.get("FULL_REFIT_EVERY", 30))
+DRIFT_THRESHOLD = float(os.environ.get("DRIFT_THRESHOLD", 2.0))
+DRIFT_MIN_OBS = int(os.environ.get("DRIFT_MIN_OBS", 7))
+
+# Single-flight training: a named detached Ray actor hands every caller that
+# wants the same product trained the same task, and keeps the last
+# TRAINING_RESULTS_KEPT results in the object store for late arrivals.
+TRAINING_COORDINATOR_NAME = "TrainingCoordinator"
+TRAINING_COORDINATOR_NAMESPACE = "demand-app"
+TRAINING_RESULTS_KEPT = int(os.environ.get("TRAINING_RESULTS_KEPT", 256))
+
+# Under Ray the compact dataset is built once by a named detached actor and
+# shared through the object store; replicas map it read-only instead of each
+# loading their own copy.
+DATASET_STORE_NAME = "DatasetStore"
+
+# Background training scheduler: TRAINING_WORKERS threads train queued
+# products, reads first; retrains caused by /add_data wait RETRAIN_DEBOUNCE_S
+# after the product's last invalidation so a burst retrains once.
+TRAINING_WORKERS = int(os.environ.get("TRAINING_WORKERS", 2))
+RETRAIN_DEBOUNCE_S = float(os.environ.get("RETRAIN_DEBOUNCE_S", 30))
+# A product whose training failed isn't retried for TRAINING_RETRY_BACKOFF_S,
+# doubling with each further failure up to TRAINING_RETRY_MAX_S, unless new
+# data arrives for it or an admin forces a retrain.
+TRAINING_RETRY_BACKOFF_S = float(os.environ.get("TRAINING_RETRY_BACKOFF_S", 300))
+TRAINING_RETRY_MAX_S = float(os.environ.get("TRAINING_RETRY_MAX_S", 6 * 3600))
+
+# Fallback forecasts for products without a ready SARIMAX model: a weekly
+# seasonal profile from exponentially weighted means of the last
+# FALLBACK_WEEKS weeks (FALLBACK_ALPHA = 1 is seasonal naive). Products with
+# fewer than MIN_POSITIVE_OBS days of non-zero sales are never trained and
+# are always answered from the fallback.
+FALLBACK_WEEKS = int(os.environ.get("FALLBACK_WEEKS", 8))
+FALLBACK_ALPHA = float(os.environ.get("FALLBACK_ALPHA", 0.5))
+MIN_POSITIVE_OBS = 14
+
+# SARIMA order search. Candidates from the order cache (the product's last
+# order, then the orders most often picked in its category/brand) are fitted
+# first, then a stepwise search moves to better neighbouring orders until none
+# improves the AIC or the search has used ORDER_SEARCH_MAX_FITS fits or
+# ORDER_SEARCH_BUDGET_S seconds.
+ORDER_SEARCH_MAX_FITS = int(os.environ.get("ORDER_SEARCH_MAX_FITS", 6))
+ORDER_SEARCH_BUDGET_S = float(os.environ.get("ORDER_SEARCH_BUDGET_S", 30))
+ORDER_CANDIDATES = int(os.environ.get("ORDER_CANDIDATES", 3))
 
-# Logging
-logging.basicConfig(level=logging.INFO)
+# Rolling-origin backtests: BACKTEST_CUTOFFS forecast origins
+# BACKTEST_STEP_DAYS apart, the last one BACKTEST_HORIZON days before the end
+# of the product's history, each scored over the following BACKTEST_HORIZON
+# days. A product is fitted once, at its first cutoff.
+BACKTEST_CUTOFFS = int(os.environ.get("BACKTEST_CUTOFFS", 8))
+BACKTEST_STEP_DAYS = int(os.environ.get("BACKTEST_STEP_DAYS", 7))
+BACKTEST_HORIZON = int(os.environ.get("BACKTEST_HORIZON", 14))
+
+# Request execution: CPU-bound work (pandas, statsmodels) runs on a bounded
+# thread pool; requests beyond MAX_PENDING_CPU_TASKS queued jobs get a 503
+# and ones waiting longer than REQUEST_TIMEOUT_S a 504.
+CPU_WORKERS = int(os.environ.get("CPU_WORKERS", 4))
+MAX_PENDING_CPU_TASKS = int(os.environ.get("MAX_PENDING_CPU_TASKS", 64))
+REQUEST_TIMEOUT_S = float(os.environ.get("REQUEST_TIMEOUT_S", 120))
+
+# Ray Serve deployment. NUM_REPLICAS=auto enables autoscaling between
+# AUTOSCALE_MIN_REPLICAS and AUTOSCALE_MAX_REPLICAS.
+NUM_REPLICAS = os.environ.get("NUM_REPLICAS", "1")
+AUTOSCALE_MIN_REPLICAS = int(os.environ.get("AUTOSCALE_MIN_REPLICAS", 1))
+AUTOSCALE_MAX_REPLICAS = int(os.environ.get("AUTOSCALE_MAX_REPLICAS", 4))
+AUTOSCALE_TARGET_ONGOING_REQUESTS = int(os.environ.get("AUTOSCALE_TARGET_ONGOING_REQUESTS", 8))
+MAX_ONGOING_REQUESTS = int(os.environ.get("MAX_ONGOING_REQUESTS", 100))
+REPLICA_NUM_CPUS = float(os.environ.get("REPLICA_NUM_CPUS", 1))
+
+# Number of Monte Carlo demand paths for stockout probabilities
+MONTE_CARLO_PATHS = int(os.environ.get("MONTE_CARLO_PATHS", 2000))
+
+# Plot rendering
+PLOT_WORKERS = int(os.environ.get("PLOT_WORKERS", 2))
+
+# Forecast result cache
+FORECAST_CACHE_SIZE = int(os.environ.get("FORECAST_CACHE_SIZE", 1024))
+FORECAST_CACHE_TTL_S = int(os.environ.get("FORECAST_CACHE_TTL_S", 3600))
+
+# Ingestion log compaction
+COMPACT_INTERVAL_S = int(os.environ.get("COMPACT_INTERVAL_S", 300))
+COMPACT_MAX_RECORDS = int(os.environ.get("COMPACT_MAX_RECORDS", 1000))
+
+# Bulk ingestion (/add_data_batch): request body limit and how many rejected
+# rows are listed in the response
+MAX_INGEST_BATCH_BYTES = int(os.environ.get("MAX_INGEST_BATCH_BYTES", 64 * 1024 * 1024))
+INGEST_ERRORS_REPORTED = int(os.environ.get("INGEST_ERRORS_REPORTED", 100))
+
+# Sampling profiler (/profile/*): off unless PROFILER_ENABLED=1; samples
+# every thread's stack each PROFILE_INTERVAL_S while a profile is running.
+PROFILER_ENABLED = os.environ.get("PROFILER_ENABLED", "0") == "1"
+PROFILE_INTERVAL_S = float(os.environ.get("PROFILE_INTERVAL_S", 0.005))
+PROFILE_MAX_DEPTH = int(os.environ.get("PROFILE_MAX_DEPTH", 64))
+
+# Logging; LOG_LEVEL=DEBUG adds per-prediction frame dumps
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
 warnings.filterwarnings("ignore", category=ConvergenceWarning)
 
+# Prometheus metrics served on /metrics, one registry per service instance
+# (so per replica process). Stage timings are histograms; cache, queue and
+# dataset figures are gauges refreshed when /metrics is scraped.
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SERVICE_GAUGES = [
+    ("forecast_cache_entries", "Entries in the forecast cache"),
+    ("forecast_cache_hits", "Forecast cache hits since start"),
+    ("forecast_cache_misses", "Forecast cache misses since start"),
+    ("forecast_cache_hit_rate", "Forecast cache hit rate since start"),
+    ("models_in_memory", "Fitted models held in memory"),
+    ("training_queue_depth", "Training jobs queued"),
+    ("training_running", "Training jobs running"),
+    ("training_failed", "Products whose last training failed"),
+    ("dataset_products", "Products in the partitioned store"),
+    ("dataset_rows", "Daily rows in the partitioned store"),
+    ("ingest_pending_frames", "Ingested frames not yet compacted into the dataset"),
+]
+
+class ServiceMetrics:
+    def __init__(self):
+        self.registry = CollectorRegistry()
+        self.stage_seconds = Histogram(
+            "forecast_stage_seconds", "Time spent in each stage of serving a request", ["stage"],
+            buckets=STAGE_BUCKETS, registry=self.registry)
+        self.model_lookups = MetricCounter(
+            "model_lookups_total", "Model lookups by where the model came from (memory, disk or trained)",
+            ["source"], registry=self.registry)
+        self.gauges = {name: Gauge(name, description, registry=self.registry) for name, description in SERVICE_GAUGES}
+
+    # Context manager timing one stage
+    def stage(self, name):
+        return self.stage_seconds.labels(name).time()
+
+    def render(self, values):
+        for name, value in values.items():
+            self.gauges[name].set(value)
+        return generate_latest(self.registry)
+
+# Times a whole ForecastingService method as one stage
+def timed_stage(stage):
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.stage(stage):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+# Sampling profiler: a thread that records every other thread's stack each
+# interval. report() gives collapsed stacks ("outer;...;inner count" lines),
+# the input format of flamegraph.pl and speedscope.
+class SamplingProfiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.stacks = Counter()
+        self.samples = 0
+        self.started = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, interval_s):
+        with self.lock:
+            if self.running:
+                raise RuntimeError("A profile is already running")
+            self.stacks, self.samples, self.started = Counter(), 0, time.time()
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self.sample_loop, args=(interval_s,), daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            if not self.running:
+                raise RuntimeError("No profile is running")
+            self.stop_event.set()
+            self.thread.join()
+            return self.report()
+
+    def sample_loop(self, interval_s):
+        own = threading.get_ident()
+        while not self.stop_event.wait(interval_s):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < PROFILE_MAX_DEPTH:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def report(self):
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+    def status(self, top=20):
+        # Functions most often on top of a stack, i.e. where the time goes
+        leaves = Counter()
+        for stack, count in list(self.stacks.items()):
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        return {"running": self.running, "started": self.started, "samples": self.samples,
+                "top": [{"function": function, "samples": count} for function, count in leaves.most_common(top)]}
+
 # Create model directory
 try:
     os.makedirs(MODEL_DIR, exist_ok=True)
@@ -36,30 +291,75 @@ try:
 except Exception as e:
     logger.error(f"Failed to create model directory {MODEL_DIR}: {e}")
 
-# Load and validate data
-try:
-    df = pd.read_csv(DATA_PATH, parse_dates=["Date"], dtype={"Opening Stock Level": float, "Remaining Stock Level": float})
-    if df.empty:
-        raise ValueError("Dataset is empty")
-    PRODUCT_IDS = sorted(df["product_id"].dropna().unique())
-    logger.info(f"Dataset loaded. Columns: {df.columns}")
-    logger.info(f"Sample data:\n{df.head().to_string()}")
-    for pid in PRODUCT_IDS:
-        stock_data = df[df["product_id"] == pid][["Date", "Opening Stock Level", "Remaining Stock Level"]].tail(5)
-        if stock_data["Opening Stock Level"].isna().any() or (stock_data["Opening Stock Level"] <= 0).any():
-            logger.warning(f"Invalid Opening Stock Levels for {pid}:\n{stock_data.to_string()}")
-        elif stock_data["Remaining Stock Level"].isna().any() or (stock_data["Remaining Stock Level"] < 0).any():
-            logger.warning(f"Invalid remaining stock levels for {pid}:\n{stock_data.to_string()}")
+def snapshot_is_current():
+    return os.path.exists(SNAPSHOT_PATH) and (
+        not os.path.exists(DATA_PATH) or os.path.getmtime(SNAPSHOT_PATH) >= os.path.getmtime(DATA_PATH)
+        or ingested_is_current())
+
+# Identifies the snapshot a set of ingested rows extends; rewriting the
+# snapshot (or, for a directory, any of its parts) changes it
+def snapshot_stamp():
+    return str(os.stat(SNAPSHOT_PATH).st_mtime_ns)
+
+# True when INGESTED_PATH extends the current snapshot and is at least as
+# new as the CSV, i.e. snapshot + ingested rows == CSV
+def ingested_is_current():
+    if pa is None or not os.path.exists(INGESTED_PATH) or not os.path.exists(SNAPSHOT_PATH):
+        return False
+    import pyarrow.parquet as pq
+    metadata = pq.read_schema(INGESTED_PATH).metadata or {}
+    return metadata.get(b"snapshot_stamp", b"").decode() == snapshot_stamp() and (
+        not os.path.exists(DATA_PATH) or os.path.getmtime(INGESTED_PATH) >= os.path.getmtime(DATA_PATH))
+
+# Load and validate data. Called from ForecastingService.__init__ (and the
+# --train-all CLI) rather than at import, so importing this module is cheap.
+# Only SERVICE_COLUMNS are read, in the compact dtypes of compact_dtypes.
+def load_dataset():
+    try:
+        use_snapshot = snapshot_is_current()
+        wanted = set(SERVICE_COLUMNS)
+        if use_snapshot:
+            import pyarrow.dataset
+            present = pyarrow.dataset.dataset(SNAPSHOT_PATH, format="parquet").schema.names
+            df = pd.read_parquet(SNAPSHOT_PATH, columns=[col for col in present if col in wanted])
+            if ingested_is_current():
+                present = pyarrow.dataset.dataset(INGESTED_PATH, format="parquet").schema.names
+                ingested = pd.read_parquet(INGESTED_PATH, columns=[col for col in present if col in wanted])
+                df = pd.concat([df, ingested], ignore_index=True)
+            df["Date"] = pd.to_datetime(df["Date"])
         else:
-            logger.info(f"Stock data for {pid}:\n{stock_data.to_string()}")
-except FileNotFoundError:
-    logger.error(f"Dataset file not found: {DATA_PATH}")
-    df = pd.DataFrame()
-    PRODUCT_IDS = []
-except Exception as e:
-    logger.error(f"Error loading dataset: {e}")
-    df = pd.DataFrame()
-    PRODUCT_IDS = []
+            df = pd.read_csv(DATA_PATH, parse_dates=["Date"], usecols=lambda col: col in wanted)
+        if df.empty:
+            raise ValueError("Dataset is empty")
+        df = compact_dtypes(df)
+        logger.info(f"Dataset loaded from {SNAPSHOT_PATH if use_snapshot else DATA_PATH}: {len(df)} rows, columns: {list(df.columns)}")
+        logger.debug(f"Sample data:\n{df.head().to_string()}")
+        validate_dataset(df)
+        return df
+    except FileNotFoundError:
+        logger.error(f"Dataset file not found: {DATA_PATH}")
+    except Exception as e:
+        logger.error(f"Error loading dataset: {e}")
+    return pd.DataFrame()
+
+# Checks each product's five most recent stock levels in one grouped pass
+def validate_dataset(df):
+    recent = df[["product_id", "Date", "Opening Stock Level", "Remaining Stock Level"]].groupby("product_id", observed=True).tail(5)
+    opening = recent["Opening Stock Level"]
+    remaining = recent["Remaining Stock Level"]
+    flags = pd.DataFrame({
+        "product_id": recent["product_id"],
+        "bad_opening": opening.isna() | (opening <= 0),
+        "bad_remaining": remaining.isna() | (remaining < 0)
+    }).groupby("product_id", observed=True).any()
+    bad_opening = flags.index[flags["bad_opening"]]
+    bad_remaining = flags.index[flags["bad_remaining"] & ~flags["bad_opening"]]
+    for pid in bad_opening:
+        logger.warning(f"Invalid Opening Stock Levels for {pid}:\n{recent[recent['product_id'] == pid].to_string()}")
+    for pid in bad_remaining:
+        logger.warning(f"Invalid remaining stock levels for {pid}:\n{recent[recent['product_id'] == pid].to_string()}")
+    logger.info(f"Validated stock levels for {len(flags)} products: {len(bad_opening)} with invalid opening, "
+                f"{len(bad_remaining)} with invalid remaining levels")
 
 # Exogenous variables for SARIMAX
 EXOG_VARS = [
@@ -69,13 +369,1570 @@ EXOG_VARS = [
     "Sales_Rolling_Std_7", "Sales_EMA_7", "Profit_Margin", "Discount_Rate",
     "Holiday", "Quarter", "Is_Weekend"
 ]
-EXOG_VARS = [var for var in EXOG_VARS if var in df.columns]
+
+# The subset of EXOG_VARS present in a dataset or partition
+def exog_vars_for(frame):
+    return [var for var in EXOG_VARS if var in frame.columns]
+
+# Columns the service reads; the rest of the cleaned dataset (supplier,
+# shipping, product names, derived stock features, ...) is never loaded
+SERVICE_COLUMNS = ["product_id", "Date", "Sales Volume", "Opening Stock Level", "Remaining Stock Level",
+                   "Reorder Point", "Lead Time (Days)", "category", "brand"] + EXOG_VARS
+CATEGORICAL_COLUMNS = ["product_id", "category", "brand"]
+
+# Narrowest dtype that holds every value exactly: whole numbers without gaps
+# become the smallest integer type, other floats float32 when they survive
+# the round trip; anything else is left alone
+def narrow_numeric(values):
+    if pd.api.types.is_integer_dtype(values):
+        return pd.to_numeric(values, downcast="integer")
+    if not pd.api.types.is_float_dtype(values):
+        return values
+    data = values.to_numpy()
+    with np.errstate(invalid="ignore"):
+        if not values.isna().any() and np.isfinite(data).all() and (data == np.round(data)).all() \
+                and np.abs(data).max(initial=0) < 2 ** 31:
+            return pd.to_numeric(values.astype(np.int64), downcast="integer")
+        narrowed = data.astype(np.float32)
+        if ((narrowed.astype(np.float64) == data) | np.isnan(data)).all():
+            return pd.Series(narrowed, index=values.index, name=values.name)
+    return values
+
+# Categorical codes for the id/group columns and narrow numeric columns
+def compact_dtypes(frame):
+    for col in frame.columns:
+        if col in CATEGORICAL_COLUMNS:
+            frame[col] = frame[col].astype("category")
+        elif col != "Date":
+            frame[col] = narrow_numeric(frame[col])
+    return frame
+
+# Per-product partitioned store: one date-indexed, daily frame per product.
+# Sales Volume stays NaN on days without an observation so callers can tell
+# gaps (summed as 0 for training) from reported zeros; everything else is ffilled.
+def build_partition(rows):
+    rows = rows.sort_values("Date", kind="stable")
+    by_date = rows.groupby("Date")
+    daily = by_date.last()
+    if "Sales Volume" in daily.columns:
+        daily["Sales Volume"] = by_date["Sales Volume"].sum(min_count=1)
+    daily = daily.asfreq("D")
+    other_cols = [col for col in daily.columns if col != "Sales Volume"]
+    daily[other_cols] = daily[other_cols].ffill()
+    return daily
+
+def build_partitions(frame):
+    if frame.empty:
+        return {}
+    return {pid: build_partition(rows) for pid, rows in frame.groupby("product_id", sort=False, observed=True)}
+
+# Compact store: every product's partition concatenated into one Date-indexed
+# frame, plus each product's row range in it
+def build_store(frame):
+    partitions = build_partitions(frame)
+    if not partitions:
+        return {"frame": pd.DataFrame(), "bounds": {}}
+    lengths = np.array([len(partition) for partition in partitions.values()])
+    ends = np.cumsum(lengths)
+    store = compact_dtypes(pd.concat(partitions.values()))
+    return {"frame": store, "bounds": dict(zip(partitions, zip((ends - lengths).tolist(), ends.tolist())))}
+
+# The partitions of a store as a product -> frame mapping. Base partitions
+# are row slices of the store frame (views, not copies); partitions replaced
+# after ingestion are kept separately.
+class PartitionStore(MutableMapping):
+    def __init__(self, store):
+        self.frame = store["frame"]
+        self.bounds = store["bounds"]
+        self.updated = {}
+
+    def __getitem__(self, product_id):
+        if product_id in self.updated:
+            return self.updated[product_id]
+        start, end = self.bounds[product_id]
+        return self.frame.iloc[start:end]
+
+    def __setitem__(self, product_id, partition):
+        self.updated[product_id] = partition
+
+    def __delitem__(self, product_id):
+        if product_id not in self.bounds and product_id not in self.updated:
+            raise KeyError(product_id)
+        self.bounds.pop(product_id, None)
+        self.updated.pop(product_id, None)
+
+    def __iter__(self):
+        yield from self.bounds
+        yield from (pid for pid in list(self.updated) if pid not in self.bounds)
+
+    def __len__(self):
+        return len(self.bounds) + sum(pid not in self.bounds for pid in list(self.updated))
+
+    def row_count(self):
+        rows = sum(end - start for pid, (start, end) in self.bounds.items() if pid not in self.updated)
+        return rows + sum(len(partition) for partition in list(self.updated.values()))
+
+# Holder of the shared store. Keyed by the dataset files' size and mtime, so a
+# replica starting after a compaction or a new cleaning run gets a fresh
+# build; the ref is returned inside a list so callers get the ref itself.
+@ray.remote(num_cpus=0)
+class DatasetStore:
+    def __init__(self):
+        self.key = None
+        self.ref = None
+
+    def get(self, key):
+        if key != self.key:
+            started = time.perf_counter()
+            store = build_store(load_dataset())
+            self.key, self.ref = key, ray.put(store)
+            logger.info(f"Built shared dataset store ({store['frame'].memory_usage(deep=True).sum() / 2**20:.1f} MiB) "
+                        f"in {time.perf_counter() - started:.2f}s")
+        return [self.ref]
+
+def dataset_key():
+    key = []
+    for path in (DATA_PATH, SNAPSHOT_PATH, INGESTED_PATH):
+        try:
+            stat = os.stat(path)
+            key.append((path, stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            key.append((path, None, None))
+    return tuple(key)
+
+def load_store():
+    if ray.is_initialized():
+        holder = DatasetStore.options(name=DATASET_STORE_NAME, namespace=TRAINING_COORDINATOR_NAMESPACE,
+                                      lifetime="detached", get_if_exists=True).remote()
+        [ref] = ray.get(holder.get.remote(dataset_key()))
+        return ray.get(ref)
+    return build_store(load_dataset())
+
+# Writes the base dataset plus new_rows to path for a compaction. The CSV is
+# copied and the rows appended in its column order, so columns the service
+# doesn't load are kept; when the Parquet snapshot is newer than the CSV the
+# CSV is rebuilt from it first. While the snapshot is the current base, the
+# rows are also added to a new INGESTED_PATH, written next to it as a temp
+# file for publish_ingested to swap in once the CSV is in place.
+def write_base(path, new_rows):
+    snapshot_current = snapshot_is_current()
+    previous = pd.read_parquet(INGESTED_PATH) if snapshot_current and ingested_is_current() else None
+    if snapshot_current and previous is None:
+        base = pd.read_parquet(SNAPSHOT_PATH)
+        pd.concat([base, new_rows], ignore_index=True).to_csv(path, index=False)
+    elif os.path.exists(DATA_PATH):
+        with open(DATA_PATH, newline="") as f:
+            header = next(csv.reader(f))
+        shutil.copyfile(DATA_PATH, path)
+        new_rows.reindex(columns=header).to_csv(path, mode="a", header=False, index=False)
+    else:
+        new_rows.to_csv(path, index=False)
+    if snapshot_current and pa is not None:
+        import pyarrow.parquet as pq
+        ingested = pd.concat([previous, new_rows], ignore_index=True) if previous is not None else new_rows
+        table = pa.Table.from_pandas(ingested, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), b"snapshot_stamp": snapshot_stamp().encode()})
+        pq.write_table(table, INGESTED_PATH + ".tmp")
+
+# Second step of write_base, after the CSV and checkpoint were replaced. A
+# crash in between leaves the old file, older than the CSV, so the CSV is
+# loaded instead: slower, but complete.
+def publish_ingested():
+    if os.path.exists(INGESTED_PATH + ".tmp"):
+        os.replace(INGESTED_PATH + ".tmp", INGESTED_PATH)
+        os.utime(INGESTED_PATH)
+
+def append_to_partition(partition, new_rows):
+    if partition is None:
+        return build_partition(new_rows)
+    return build_partition(pd.concat([partition.reset_index(), new_rows], ignore_index=True))
+
+# Ingested rows use the /add_data field names (or the dataset's own column
+# names); these are the required ones, mapped to dataset columns.
+INGEST_COLUMNS = {
+    "product_id": "product_id",
+    "date": "Date",
+    "sales_volume": "Sales Volume",
+    "opening_stock_level": "Opening Stock Level",
+    "remaining_stock_level": "Remaining Stock Level"
+}
+
+def parse_ingest_batch(body, content_type):
+    if not body.strip():
+        raise ValueError("No rows in request body")
+    if "csv" in content_type:
+        frame = pd.read_csv(io.BytesIO(body), dtype=str, skipinitialspace=True)
+    else:
+        frame = pd.read_json(io.BytesIO(body), lines=True, dtype=False, convert_dates=False)
+    return frame.rename(columns=INGEST_COLUMNS)
+
+# Coerces the batch to dataset dtypes in one pass per column and returns the
+# valid rows plus a list of {"row", "error"} for the rest (first problem per
+# row, rows numbered from 0 in upload order).
+def validate_ingest_rows(frame, exog_vars):
+    missing = [name for name, col in INGEST_COLUMNS.items() if col not in frame.columns]
+    if missing:
+        raise ValueError(f"Missing columns: {missing}")
+    frame = frame.reset_index(drop=True)
+    frame["product_id"] = frame["product_id"].astype("string").str.strip()
+    frame["Date"] = pd.to_datetime(frame["Date"], errors="coerce")
+    checks = [("missing product_id", frame["product_id"].isna() | (frame["product_id"] == "")),
+              ("invalid product_id", frame["product_id"].str.contains(r"[/\\\x00]|^\.\.?$", na=False)),
+              ("invalid date", frame["Date"].isna())]
+    for name, col in list(INGEST_COLUMNS.items())[2:]:
+        values = pd.to_numeric(frame[col], errors="coerce")
+        checks.append((f"invalid {name}", values.isna() | (values < 0)))
+        frame[col] = values.astype(float)
+    for var in [var for var in exog_vars if var in frame.columns]:
+        values = pd.to_numeric(frame[var], errors="coerce")
+        checks.append((f"invalid {var}", values.isna() & frame[var].notna()))
+        frame[var] = values
+
+    error = pd.Series(None, index=frame.index, dtype=object)
+    for message, failed in reversed(checks):
+        error[failed.to_numpy()] = message
+    bad = error.notna()
+    errors = [{"row": int(row), "error": message} for row, message in error[bad].items()]
+    frame["product_id"] = frame["product_id"].astype(object)
+    return frame[~bad], errors
+
+# Exclusive advisory lock on path across processes; without fcntl only the
+# caller's own locks apply
+@contextmanager
+def file_lock(path):
+    if fcntl is None:
+        yield
+        return
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+# Append-only ingestion log. New rows are appended as one fsynced JSON line
+# per record ({"seq": n, "rows": [...]}) instead of rewriting the dataset;
+# compaction later folds them into DATA_PATH. The checkpoint file holds the
+# last seq already contained in DATA_PATH, so replay skips those records.
+# Every replica writes the same log: appends and the log rewrite hold an
+# fcntl lock on path.lock, a writer reads the records others appended before
+# numbering its own (so seq is global), and reopens the log when a compaction
+# has replaced it. Compactions are serialised by a second lock and fold every
+# writer's records into the base, not just their own.
+class IngestLog:
+    def __init__(self, path, checkpoint_path, base_path):
+        self.path = path
+        self.checkpoint_path = checkpoint_path
+        self.base_path = base_path
+        self.lock_path = path + ".lock"
+        self.compact_lock_path = path + ".compact.lock"
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.checkpoint = 0
+        # Records past the checkpoint, from every writer, as of the last read
+        self.pending = 0
+        self.offset = 0
+        self.file = None
+
+    # A compaction that died between its two renames leaves the new
+    # checkpoint behind as a temp file. If the new base was already renamed
+    # into place the checkpoint must be promoted too; otherwise both are stale.
+    def recover(self):
+        base_tmp = self.base_path + ".tmp"
+        checkpoint_tmp = self.checkpoint_path + ".tmp"
+        if os.path.exists(checkpoint_tmp):
+            if os.path.exists(base_tmp):
+                os.remove(checkpoint_tmp)
+            else:
+                os.replace(checkpoint_tmp, self.checkpoint_path)
+        if os.path.exists(base_tmp):
+            os.remove(base_tmp)
+
+    def read_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path):
+            return 0
+        with open(self.checkpoint_path) as f:
+            return json.load(f)["seq"]
+
+    # Reads the records in path from the byte offset on, returning them and
+    # the offset after the last complete one
+    def read_records(self, offset=0):
+        records = []
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("unterminated record")
+                    records.append(json.loads(line))
+                except ValueError:
+                    logger.warning(f"Dropping torn record at byte {offset} of {self.path}")
+                    break
+                offset += len(line)
+        return records, offset
+
+    # Catches up with the shared log; called holding the file lock. When a
+    # compaction has replaced the log (new inode), the new file is read from
+    # the start against the new checkpoint.
+    def follow(self):
+        if self.file is None or os.fstat(self.file.fileno()).st_ino != os.stat(self.path).st_ino:
+            if self.file is not None:
+                self.file.close()
+            self.file = open(self.path, "a")
+            self.checkpoint = self.read_checkpoint()
+            self.seq = max(self.seq, self.checkpoint)
+            self.offset = self.pending = 0
+        size = os.fstat(self.file.fileno()).st_size
+        if size > self.offset:
+            records, self.offset = self.read_records(self.offset)
+            for record in records:
+                self.seq = max(self.seq, record["seq"])
+                if record["seq"] > self.checkpoint:
+                    self.pending += 1
+            if self.offset < size:
+                # Appends hold the lock, so a partial record is from a writer that died mid-write
+                os.truncate(self.path, self.offset)
+        return self.seq
+
+    # Returns the rows not yet compacted into the base dataset. A torn
+    # trailing record from a crash mid-write is dropped and truncated away so
+    # later appends start on a clean line.
+    def replay(self):
+        with file_lock(self.compact_lock_path), self.lock, file_lock(self.lock_path):
+            self.recover()
+            checkpoint = self.read_checkpoint()
+            rows = []
+            if os.path.exists(self.path):
+                records, valid_bytes = self.read_records()
+                for record in records:
+                    if record["seq"] > checkpoint:
+                        rows.extend(record["rows"])
+                if valid_bytes < os.path.getsize(self.path):
+                    os.truncate(self.path, valid_bytes)
+            self.follow()
+        frame = pd.DataFrame(rows)
+        if not frame.empty:
+            frame["Date"] = pd.to_datetime(frame["Date"])
+        logger.info(f"Replayed {len(frame)} rows from ingestion log (checkpoint seq {checkpoint})")
+        return frame
+
+    def append(self, frame):
+        rows = frame.to_json(orient="records", date_format="iso")
+        with self.lock, file_lock(self.lock_path):
+            self.seq = self.follow() + 1
+            self.file.write(f'{{"seq": {self.seq}, "rows": {rows}}}\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.offset = self.file.tell()
+            self.pending += 1
+            return self.seq
+
+    # write_base(path, rows) writes the base dataset plus rows (a frame of
+    # every record not yet in it, from all writers) to path; it replaces the
+    # base, calls after_replace if given, then the compacted records are
+    # dropped from the log. Appends continue while the base is written.
+    # Returns the number of rows folded and the last seq folded.
+    def compact(self, write_base, after_replace=None):
+        with file_lock(self.compact_lock_path):
+            with self.lock, file_lock(self.lock_path):
+                checkpoint = self.read_checkpoint()
+                records, _ = self.read_records()
+            records = [record for record in records if record["seq"] > checkpoint]
+            if not records:
+                return 0, checkpoint
+            seq = max(record["seq"] for record in records)
+            new_rows = pd.DataFrame([row for record in records for row in record["rows"]])
+            new_rows["Date"] = pd.to_datetime(new_rows["Date"])
+
+            base_tmp = self.base_path + ".tmp"
+            checkpoint_tmp = self.checkpoint_path + ".tmp"
+            write_base(base_tmp, new_rows)
+            with open(checkpoint_tmp, "w") as f:
+                json.dump({"seq": seq}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(base_tmp, self.base_path)
+            os.replace(checkpoint_tmp, self.checkpoint_path)
+            if after_replace is not None:
+                after_replace()
+
+            with self.lock, file_lock(self.lock_path):
+                log_tmp = f"{self.path}.{os.getpid()}.tmp"
+                records, _ = self.read_records()
+                with open(log_tmp, "w") as dst:
+                    for record in records:
+                        if record["seq"] > seq:
+                            dst.write(json.dumps(record) + "\n")
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                os.replace(log_tmp, self.path)
+                self.follow()
+            return len(new_rows), seq
+
+# Stockout simulation. demand is (days,) or (paths, days) of non-negative
+# units; stock is drawn down by cumulative demand and floors at zero, and a
+# day is a stockout when it has demand the remaining stock cannot cover.
+# Equivalent to walking the days one by one, but a single array operation.
+def simulate_stock(starting_stock, demand):
+    demand = np.asarray(demand, dtype=float)
+    balance = np.expand_dims(np.asarray(starting_stock, dtype=float), -1) - np.cumsum(demand, axis=-1)
+    remaining = np.round(np.maximum(balance, 0)).astype(int)
+    stockout = (balance < 0) & (demand > 0)
+    return remaining, stockout
+
+# Draws n_paths joint demand paths from the SARIMAX forecast distribution.
+# h-step forecast errors are sum_j psi_j * e_(h-j) with psi the model's
+# impulse responses, so all paths come from one matrix product of Gaussian
+# innovations with the lower-triangular psi matrix (parameter uncertainty
+# is ignored, as in the model's own forecast intervals).
+def sample_demand_paths(fitted, steps, exog, n_paths, rng=None):
+    rng = np.random.default_rng() if rng is None else rng
+    mean = np.asarray(fitted.forecast(steps=steps, exog=exog), dtype=float)
+    psi = np.ravel(fitted.impulse_responses(steps=steps))[:steps]
+    lag = np.subtract.outer(np.arange(steps), np.arange(steps))
+    weights = np.where(lag >= 0, psi[np.clip(lag, 0, None)], 0.0)
+    sigma = np.sqrt(fitted.params["sigma2"])
+    shocks = rng.standard_normal((n_paths, steps)) * sigma
+    return np.round(np.clip(mean + shocks @ weights.T, 0, None))
+
+# Summarises simulated paths: probability of a stockout on each day, of having
+# stocked out by each day, over the whole range, and the expected first
+# stockout date among the paths that do stock out.
+def stockout_risk(starting_stock, paths, dates):
+    _, stockout = simulate_stock(starting_stock, paths)
+    any_stockout = stockout.any(axis=1)
+    first_day = stockout.argmax(axis=1)
+    cumulative = np.maximum.accumulate(stockout, axis=1).mean(axis=0)
+    expected_date = None
+    if any_stockout.any():
+        expected_offset = int(round(first_day[any_stockout].mean()))
+        expected_date = dates[expected_offset].strftime("%Y-%m-%d")
+    return {
+        "stockout_probability": np.round(stockout.mean(axis=0), 4).tolist(),
+        "cumulative_stockout_probability": np.round(cumulative, 4).tolist(),
+        "stockout_risk": round(float(any_stockout.mean()), 4),
+        "expected_stockout_date": expected_date,
+        "simulated_paths": len(paths)
+    }
+
+# Renders the demand vs stock chart to PNG bytes. Uses a standalone Figure
+# rather than pyplot so concurrent renders don't share global figure state.
+def render_plot_png(frame, product_id):
+    fig = Figure(figsize=(10, 4))
+    ax = fig.add_subplot()
+    ax.plot(frame["Date"], frame["Forecasted Demand"], label="Forecasted Demand", marker="o")
+    ax.plot(frame["Date"], frame["Opening Stock Level"], label="Opening Stock Level", marker="x")
+    ax.plot(frame["Date"], frame["Remaining Stock Level"], label="Remaining Stock Level", marker="s")
+    ax.fill_between(frame["Date"], 0, frame["Forecasted Demand"], where=frame["Stockout"], color="red", alpha=0.3, label="Stock-out Risk")
+    ax.set_title(f"Demand vs Stock - {product_id}")
+    ax.set_xlabel("Date")
+    ax.set_ylabel("Units")
+    ax.tick_params(axis="x", labelrotation=45)
+    ax.legend()
+    fig.tight_layout()
+
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png")
+    return buf.getvalue()
+
+# Bounded LRU/TTL cache of forecast results keyed by (product, model version,
+# start date). Forecasts are anchored at the end of the model's sample, so a
+# request is a prefix of any cached entry with the same start date and a later
+# end date; each entry keeps the longest horizon seen so far.
+class ForecastCache:
+    def __init__(self, max_entries, ttl_s):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, product_id, version, start_date, end_date):
+        key = (product_id, version, start_date)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry["created"] > self.ttl_s:
+                del self.entries[key]
+                entry = None
+            if entry is None or entry["end_date"] < end_date:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, product_id, version, start_date, end_date, value):
+        key = (product_id, version, start_date)
+        entry = {"end_date": end_date, "created": time.monotonic(), "plots": {}, **value}
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return entry
+
+    def invalidate(self, product_id):
+        with self.lock:
+            stale = [key for key in self.entries if key[0] == product_id]
+            for key in stale:
+                del self.entries[key]
+            self.invalidations += len(stale)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries), "max_entries": self.max_entries, "ttl_s": self.ttl_s,
+                "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions, "invalidations": self.invalidations
+            }
+
+# Weekday profiles for a products x (weeks * 7) matrix of daily sales, each
+# row ending on that product's last date and NaN where there is no data.
+# Column j of the result is the level for days 7k + j + 1 after the end.
+# Weeks are weighted alpha * (1 - alpha)^age, skipping missing days; a
+# weekday with no data at all gets the row's overall mean.
+def seasonal_profiles(history, alpha):
+    n_products, n_days = history.shape
+    weeks = history.reshape(n_products, n_days // 7, 7)
+    present = ~np.isnan(weeks)
+    weights = alpha * (1 - alpha) ** np.arange(n_days // 7)[::-1]
+    weights = weights[None, :, None] * present
+    total = weights.sum(axis=1)
+    profile = (np.where(present, weeks, 0) * weights).sum(axis=1) / np.where(total > 0, total, 1)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        overall = np.nanmean(history, axis=1)
+    profile = np.where(total > 0, profile, overall[:, None])
+    return np.nan_to_num(profile, nan=0.0)
+
+# Catalog-wide fallback forecaster. build() computes every product's profile
+# in one pass; update() recomputes just the given products after ingestion.
+# Forecasts pick each date's weekday level relative to the product's last
+# date, so they don't depend on where the requested range starts.
+class FallbackForecaster:
+    def __init__(self, weeks, alpha):
+        self.n_days = weeks * 7
+        self.alpha = alpha
+        self.rows = {}
+        self.profiles = np.zeros((0, 7))
+        self.ends = np.array([], dtype="datetime64[ns]")
+        self.lock = threading.Lock()
+
+    def history_matrix(self, partitions, product_ids):
+        history = np.full((len(product_ids), self.n_days), np.nan)
+        ends = np.empty(len(product_ids), dtype="datetime64[ns]")
+        for row, product_id in enumerate(product_ids):
+            sales = partitions[product_id]["Sales Volume"].to_numpy(dtype=float)[-self.n_days:]
+            history[row, self.n_days - len(sales):] = sales
+            ends[row] = partitions[product_id].index[-1]
+        return history, ends
+
+    def build(self, partitions):
+        product_ids = [pid for pid, partition in partitions.items() if not partition.empty]
+        history, ends = self.history_matrix(partitions, product_ids)
+        profiles = seasonal_profiles(history, self.alpha)
+        with self.lock:
+            self.rows = {pid: row for row, pid in enumerate(product_ids)}
+            self.profiles, self.ends = profiles, ends
+
+    def update(self, partitions, product_ids):
+        product_ids = [pid for pid in product_ids if pid in partitions and not partitions[pid].empty]
+        if not product_ids:
+            return
+        history, ends = self.history_matrix(partitions, product_ids)
+        profiles = seasonal_profiles(history, self.alpha)
+        with self.lock:
+            new = [pid for pid in product_ids if pid not in self.rows]
+            if new:
+                for pid in new:
+                    self.rows[pid] = len(self.rows)
+                self.profiles = np.vstack([self.profiles, np.zeros((len(new), 7))])
+                self.ends = np.concatenate([self.ends, np.empty(len(new), dtype="datetime64[ns]")])
+            rows = [self.rows[pid] for pid in product_ids]
+            self.profiles[rows] = profiles
+            self.ends[rows] = ends
+
+    def forecast(self, product_id, dates):
+        with self.lock:
+            row = self.rows.get(product_id)
+            if row is None:
+                raise ValueError(f"No historical data for {product_id}")
+            profile, end = self.profiles[row], self.ends[row]
+        offsets = (pd.DatetimeIndex(dates).to_numpy() - end) // np.timedelta64(1, "D")
+        return np.round(np.clip(profile[(offsets - 1) % 7], 0, None)).astype(int)
+
+# Queue of training jobs, at most one per product, ordered by (priority, due
+# time). A product someone is waiting on is PRIORITY_REQUESTED and due now;
+# one invalidated by new data is PRIORITY_STALE and due after a delay that
+# each further invalidation pushes back. Reads promote stale jobs. Heap
+# entries superseded by a reschedule are skipped when popped. An
+# invalidation while the product is training queues one more run afterwards,
+# since the running fit started from the older partition; train_fn is
+# expected to bring the model up to the current partition.
+PRIORITY_REQUESTED = 0
+PRIORITY_STALE = 1
+PRIORITY_NAMES = {PRIORITY_REQUESTED: "requested", PRIORITY_STALE: "stale"}
+
+class TrainingScheduler:
+    def __init__(self, train_fn, workers):
+        self.train_fn = train_fn
+        self.cond = threading.Condition()
+        self.heap = []
+        self.jobs = {}
+        self.failures = {}
+        self.seq = itertools.count()
+        self.completed = 0
+        for i in range(workers):
+            threading.Thread(target=self.run, name=f"training-{i}", daemon=True).start()
+
+    # retry clears the product's failure backoff (new data, forced retrain);
+    # otherwise a product still backing off gets its failure status back
+    def schedule(self, product_id, priority, delay=0.0, retry=False):
+        with self.cond:
+            now = time.time()
+            if retry:
+                self.failures.pop(product_id, None)
+            elif product_id in self.failures and product_id not in self.jobs \
+                    and now < self.failures[product_id]["retry_at"]:
+                return self.failure_status(product_id)
+            job = self.jobs.get(product_id)
+            if job is None:
+                job = {"product_id": product_id, "status": "queued", "queued_at": now, "started_at": None,
+                       "priority": priority, "due": now + delay, "rerun": False}
+                self.jobs[product_id] = job
+            elif job["status"] == "running":
+                job["rerun"] = job["rerun"] or priority == PRIORITY_STALE
+                return dict(job)
+            elif priority < job["priority"]:
+                job["priority"], job["due"] = priority, now
+            elif priority == PRIORITY_STALE and job["priority"] == PRIORITY_STALE:
+                job["due"] = now + delay
+            else:
+                return dict(job)
+            job["seq"] = next(self.seq)
+            heapq.heappush(self.heap, (job["priority"], job["due"], job["seq"], product_id))
+            self.cond.notify()
+            return dict(job)
+
+    def status(self, product_id):
+        with self.cond:
+            job = self.jobs.get(product_id)
+            if job is not None:
+                return dict(job)
+            if product_id in self.failures:
+                return self.failure_status(product_id)
+            return None
+
+    def clear_failures(self, product_ids):
+        with self.cond:
+            for product_id in product_ids:
+                self.failures.pop(product_id, None)
+
+    def failure_status(self, product_id):
+        failure = self.failures[product_id]
+        return {"product_id": product_id, "status": "failed", "error": failure["error"],
+                "attempts": failure["attempts"], "retry_at": failure["retry_at"]}
+
+    def stats(self):
+        with self.cond:
+            statuses = [job["status"] for job in self.jobs.values()]
+            return {"queued": statuses.count("queued"), "running": statuses.count("running"),
+                    "failed": len(self.failures.keys() - self.jobs.keys()), "completed": self.completed}
+
+    def next_due(self):
+        while self.heap:
+            priority, due, seq, product_id = self.heap[0]
+            job = self.jobs.get(product_id)
+            if job is None or job["status"] != "queued" or job["seq"] != seq:
+                heapq.heappop(self.heap)
+                continue
+            if due > time.time():
+                return None, due
+            heapq.heappop(self.heap)
+            return job, None
+        return None, None
+
+    def run(self):
+        while True:
+            with self.cond:
+                job, wake_at = self.next_due()
+                while job is None:
+                    self.cond.wait(None if wake_at is None else max(0.0, wake_at - time.time()))
+                    job, wake_at = self.next_due()
+                job["status"] = "running"
+                job["started_at"] = time.time()
+            product_id = job["product_id"]
+            error = None
+            try:
+                logger.info(f"Training {product_id} ({PRIORITY_NAMES[job['priority']]}, "
+                            f"queued {job['started_at'] - job['queued_at']:.1f}s)")
+                self.train_fn(product_id)
+            except Exception as e:
+                error = str(e)
+                logger.error(f"Background training failed for {product_id}: {e}")
+            with self.cond:
+                del self.jobs[product_id]
+                self.completed += 1
+                if error is None:
+                    self.failures.pop(product_id, None)
+                else:
+                    attempts = self.failures.get(product_id, {"attempts": 0})["attempts"] + 1
+                    backoff = min(TRAINING_RETRY_BACKOFF_S * 2 ** (attempts - 1), TRAINING_RETRY_MAX_S)
+                    self.failures[product_id] = {"error": error, "attempts": attempts,
+                                                 "retry_at": time.time() + backoff}
+            if job["rerun"]:
+                # Reruns are queued by new data, which may fix the failure
+                self.schedule(product_id, PRIORITY_STALE, RETRAIN_DEBOUNCE_S, retry=True)
+
+# Prediction job ids carry the request itself, so a poll can be answered by
+# any replica, not just the one that queued the training.
+def encode_job_id(product_id, start_date, end_date, include_probability=False):
+    payload = json.dumps([product_id, start_date, end_date, include_probability], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_job_id(job_id):
+    payload = base64.urlsafe_b64decode(job_id + "=" * (-len(job_id) % 4))
+    product_id, start_date, end_date, include_probability = json.loads(payload)
+    return product_id, start_date, end_date, bool(include_probability)
+
+# Response formats for the prediction endpoints, negotiated from the Accept
+# and Accept-Encoding headers. JSON stays the default. Arrow IPC and
+# MessagePack bodies send every date range as an epoch-day start plus a
+# length, and plots as raw PNG bytes. Bodies of at least COMPRESS_MIN_BYTES
+# are compressed with brotli or gzip when the client accepts it.
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", 1024))
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+RESPONSE_MEDIA_TYPES = {"application/json": "application/json"}
+if pa is not None:
+    RESPONSE_MEDIA_TYPES[ARROW_MEDIA_TYPE] = ARROW_MEDIA_TYPE
+if msgpack is not None:
+    for alias in (MSGPACK_MEDIA_TYPE, "application/x-msgpack", "application/vnd.msgpack"):
+        RESPONSE_MEDIA_TYPES[alias] = MSGPACK_MEDIA_TYPE
+EPOCH_DAY = np.datetime64(0, "D")
+
+def epoch_days(dates):
+    return (np.asarray(dates, dtype="datetime64[D]") - EPOCH_DAY).astype(np.int64)
+
+# Header values ("a;q=0.5, b") by descending quality, refused ones dropped
+def accepted_values(header):
+    values = []
+    for position, part in enumerate(header.split(",")):
+        value, *params = [piece.strip() for piece in part.split(";")]
+        quality = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if value and quality > 0:
+            values.append((-quality, position, value.lower()))
+    return [value for _, _, value in sorted(values)]
+
+# Response media type for an Accept header, None when nothing offered is
+# acceptable
+def pick_media_type(accept):
+    if not accept:
+        return "application/json"
+    for value in accepted_values(accept):
+        if value in RESPONSE_MEDIA_TYPES:
+            return RESPONSE_MEDIA_TYPES[value]
+        if value in ("*/*", "application/*"):
+            return "application/json"
+    return None
+
+def pick_encoding(accept_encoding):
+    for value in accepted_values(accept_encoding or ""):
+        if value == "br" and brotli is not None:
+            return "br"
+        if value in ("gzip", "x-gzip", "*"):
+            return "gzip"
+    return None
+
+# Binary-format view of a prediction result: the date list becomes
+# date_start (days since 1970-01-01) and days, unless the dates aren't
+# consecutive, and the base64 plot becomes bytes.
+def compact_result(result):
+    result = dict(result)
+    dates = result.pop("dates", None)
+    if dates is not None:
+        days = epoch_days(dates)
+        if (np.diff(days) == 1).all():
+            result["date_start"] = int(days[0]) if len(days) else None
+            result["days"] = len(days)
+        else:
+            result["dates"] = dates
+    if "plot" in result:
+        result["plot"] = base64.b64decode(result["plot"])
+    return result
+
+# Same for a /predict_batch body: per-row dates become per-item date_start
+# and days (rows are grouped by item, in order)
+def compact_batch(response):
+    rows = dict(response["rows"])
+    dates = epoch_days(rows.pop("date"))
+    days = np.bincount(np.asarray(rows["item"], dtype=np.int64), minlength=response["count"])
+    first = np.cumsum(days) - days
+    date_start = [int(dates[start]) if n else None for start, n in zip(first, days)]
+    return {**response, "rows": rows, "date_start": date_start, "days": days.tolist()}
+
+def compact_content(content):
+    if "rows" in content:
+        return compact_batch(content)
+    if "result" in content:
+        return {**content, "result": compact_result(content["result"])}
+    return compact_result(content)
+
+# Arrow table with one row per prediction: per-day values are list columns
+# and date_start is a date32. A job poll's result is flattened into the row.
+def arrow_table(content):
+    if "rows" in content:
+        offsets = pa.array(np.concatenate([[0], np.cumsum(content["days"])]).astype(np.int32))
+        columns = {key: content[key] for key in ("product_id", "start_date", "end_date", "mae", "error", "fallback",
+                                                   "model_status", "days")}
+        columns["date_start"] = pa.array(content["date_start"], pa.date32())
+        for key, values in content["rows"].items():
+            if key != "item":
+                columns[key] = pa.ListArray.from_arrays(offsets, pa.array(values))
+        return pa.table(columns)
+    row = {key: value for key, value in content.items() if key != "result"}
+    row.update(content.get("result", {}))
+    columns = {}
+    for key, value in row.items():
+        columns[key] = pa.array([value], pa.date32() if key == "date_start" else None)
+    return pa.table(columns)
+
+def encode_body(content, media_type):
+    if media_type == ARROW_MEDIA_TYPE:
+        table = arrow_table(compact_content(content))
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
+    if media_type == MSGPACK_MEDIA_TYPE:
+        return msgpack.packb(compact_content(content))
+    return JSONResponse(content=content).body
+
+# Encodes a prediction payload in the format the client asked for
+def negotiated_response(request, content, status_code=200):
+    media_type = pick_media_type(request.headers.get("accept"))
+    if media_type is None:
+        return JSONResponse(content={"error": "Not acceptable", "available": sorted(set(RESPONSE_MEDIA_TYPES.values()))},
+                            status_code=406)
+    headers = {"Vary": "Accept, Accept-Encoding"}
+    encoding = pick_encoding(request.headers.get("accept-encoding"))
+    if media_type == "application/json" and encoding is None:
+        return JSONResponse(content=content, status_code=status_code, headers=headers)
+    body = encode_body(content, media_type)
+    if encoding is not None and len(body) >= COMPRESS_MIN_BYTES:
+        # Moderate levels: these are per-request compressions, not archives
+        body = brotli.compress(body, quality=5) if encoding == "br" else gzip.compress(body, compresslevel=6)
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type=media_type, status_code=status_code, headers=headers)
+
+# Model registry and compact artifacts. A model is stored as one flat float64
+# .npy (parameters, the predicted state and covariance at the start of a short
+# tail of the sample, and that tail's endog/exog), which is enough to rebuild
+# the exact filtered state for forecasting and appending. Everything else
+# about the model lives in the registry.
+# Product ids become file names (model artifacts, training locks), so ones
+# that could leave their directory are refused
+def checked_product_id(product_id):
+    if not isinstance(product_id, str) or not product_id or product_id in (".", "..") \
+            or any(sep in product_id for sep in ("/", "\\", "\0")):
+        raise ValueError(f"Invalid product_id: {product_id!r}")
+    return product_id
+
+def model_path_for(product_id):
+    return os.path.join(MODEL_DIR, f"sarima_{checked_product_id(product_id)}.npy")
+
+def legacy_model_path_for(product_id):
+    return os.path.join(MODEL_DIR, f"sarima_{checked_product_id(product_id)}.pkl")
+
+def model_exists(product_id):
+    return os.path.exists(model_path_for(product_id)) or os.path.exists(legacy_model_path_for(product_id))
+
+# Append-only JSON-lines index of model entries, last line per product wins.
+# Entries hold the version (bumped on every full fit and incremental update,
+# and kept when an artifact is invalidated), orders, artifact layout, training
+# window, fit time and metrics. Readers follow the file from the last offset
+# they consumed, so entries written by other processes show up cheaply.
+# Writers (replicas, the bulk-training CLI) hold an fcntl lock on path.lock
+# to append or compact; compaction swaps in a new file, which readers notice
+# by its inode.
+class ModelRegistry:
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = path + ".lock"
+        self.entries = {}
+        self.offset = 0
+        self.lines = 0
+        self.inode = None
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if st.st_ino == self.inode and st.st_size == self.offset:
+            return
+        with open(self.path, "rb") as f:
+            # Stat the file actually opened, in case it was swapped since
+            st = os.fstat(f.fileno())
+            if st.st_ino != self.inode or st.st_size < self.offset:
+                # Rewritten by another process's compaction; start over
+                self.reset()
+                self.inode = st.st_ino
+            f.seek(self.offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                self.apply(json.loads(line))
+                self.offset += len(line)
+                self.lines += 1
+
+    def reset(self):
+        self.entries, self.offset, self.lines = {}, 0, 0
+
+    def apply(self, entry):
+        self.entries[entry["product_id"]] = entry
+
+    def get(self, product_id):
+        with self.lock:
+            self.refresh()
+            return dict(self.entries.get(product_id, {"product_id": product_id, "version": 0}))
+
+    def all(self):
+        with self.lock:
+            self.refresh()
+            return {pid: dict(entry) for pid, entry in self.entries.items()}
+
+    def put(self, product_id, entry):
+        entry = {**entry, "product_id": product_id}
+        with self.lock, file_lock(self.lock_path):
+            self.refresh()
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+            self.refresh()
+            if self.lines > 2 * len(self.entries) + 64:
+                self.compact()
+
+    # Called from put, holding both locks, so no line can land in the old
+    # file after it was read
+    def compact(self):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        st = os.stat(self.path)
+        self.inode, self.offset = st.st_ino, st.st_size
+        self.lines = len(self.entries)
+
+MODEL_REGISTRY = ModelRegistry(REGISTRY_PATH)
+
+# Orders picked by the order search, one line per product ({"product_id",
+# "order", "seasonal_order", "aic", "category", "brand"}), kept like the model
+# registry. Per-group counts of picked orders are maintained as lines are
+# read, so looking up a new product's candidates doesn't scan the catalog.
+class OrderCache(ModelRegistry):
+    def __init__(self, path):
+        self.groups = {}
+        super().__init__(path)
+
+    def reset(self):
+        super().reset()
+        self.groups = {}
+
+    def apply(self, entry):
+        previous = self.entries.get(entry["product_id"])
+        if previous is not None:
+            self.count(previous, -1)
+        super().apply(entry)
+        self.count(entry, 1)
+
+    def count(self, entry, delta):
+        key = order_key(entry["order"], entry["seasonal_order"])
+        for group in order_groups(entry.get("category"), entry.get("brand")):
+            counts = self.groups.setdefault(group, Counter())
+            counts[key] += delta
+            if counts[key] <= 0:
+                del counts[key]
+
+    # The product's own last order first, then the most common orders of its
+    # category+brand, category, brand and finally the whole catalog
+    def candidates(self, product_id, category=None, brand=None, limit=None):
+        limit = ORDER_CANDIDATES if limit is None else limit
+        with self.lock:
+            self.refresh()
+            found = []
+            own = self.entries.get(product_id)
+            if own is not None:
+                found.append(order_key(own["order"], own["seasonal_order"]))
+            for group in order_groups(category, brand):
+                for key, _ in self.groups.get(group, Counter()).most_common(limit):
+                    if len(found) > limit:
+                        break
+                    if key not in found:
+                        found.append(key)
+            return found[:limit + 1]
+
+def order_key(order, seasonal_order):
+    return tuple(order), tuple(seasonal_order)
+
+def order_groups(category, brand):
+    known = lambda value: isinstance(value, str) and value not in ("", "Unknown")
+    groups = []
+    if known(category) and known(brand):
+        groups.append(("category_brand", category, brand))
+    if known(category):
+        groups.append(("category", category))
+    if known(brand):
+        groups.append(("brand", brand))
+    groups.append(("all",))
+    return groups
+
+# Category and brand of a product from its partition, when the dataset has them
+def product_groups(data):
+    groups = []
+    for col in ("category", "brand"):
+        value = data[col].iloc[-1] if col in data.columns and len(data) else None
+        groups.append(value if isinstance(value, str) else None)
+    return tuple(groups)
+
+ORDER_CACHE = OrderCache(ORDER_CACHE_PATH)
+
+def compact_model(fitted, tail_days=None):
+    tail_days = MODEL_TAIL_DAYS if tail_days is None else tail_days
+    model = fitted.model
+    nobs = model.nobs
+    start = max(0, nobs - tail_days)
+    endog = np.asarray(model.data.endog, dtype=float).reshape(nobs)
+    exog = np.asarray(model.data.exog, dtype=float) if model.data.exog is not None else np.empty((nobs, 0))
+    flat = np.concatenate([
+        np.asarray(fitted.params, dtype=float),
+        fitted.predicted_state[:, start],
+        fitted.predicted_state_cov[:, :, start].ravel(),
+        endog[start:],
+        exog[start:].ravel()
+    ])
+    index = fitted.fittedvalues.index
+    layout = {
+        "order": list(model.order),
+        "seasonal_order": list(model.seasonal_order),
+        "param_names": list(model.param_names),
+        "exog_names": list(model.exog_names or []),
+        "k_states": int(model.k_states),
+        "tail_start": index[start].strftime("%Y-%m-%d"),
+        "tail_len": int(nobs - start),
+        "trained_to": index[-1].strftime("%Y-%m-%d")
+    }
+    return flat, layout
+
+# flat is the artifact array when it is already in memory (e.g. fetched from
+# the object store); otherwise the saved file is memory-mapped.
+def load_compact_model(entry, flat=None):
+    if flat is None:
+        flat = np.load(model_path_for(entry["product_id"]), mmap_mode="r")
+    k_params = len(entry["param_names"])
+    k_states = entry["k_states"]
+    tail_len = entry["tail_len"]
+    k_exog = len(entry["exog_names"])
+    bounds = np.cumsum([0, k_params, k_states, k_states * k_states, tail_len, tail_len * k_exog])
+    params, a0, P0, endog, exog = (np.array(flat[lo:hi]) for lo, hi in zip(bounds[:-1], bounds[1:]))
+
+    index = pd.date_range(entry["tail_start"], periods=tail_len, freq="D")
+    endog = pd.Series(endog, index=index, name="Sales Volume")
+    exog = pd.DataFrame(exog.reshape(tail_len, k_exog), index=index, columns=entry["exog_names"]) if k_exog else None
+    model = SARIMAX(endog, exog=exog, order=tuple(entry["order"]), seasonal_order=tuple(entry["seasonal_order"]),
+                    enforce_stationarity=True, enforce_invertibility=True)
+    model.initialize_known(a0, P0.reshape(k_states, k_states))
+    return model.filter(pd.Series(params, index=entry["param_names"]))
+
+# Writes the artifact atomically and records a new registry version. extra
+# holds the fit/update metrics to merge into the registry entry.
+def save_model(product_id, flat, layout, **extra):
+    path = model_path_for(product_id)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        np.save(f, flat)
+    os.replace(tmp, path)
+    entry = MODEL_REGISTRY.get(product_id)
+    entry.update(layout)
+    entry.update(extra)
+    entry["version"] += 1
+    MODEL_REGISTRY.put(product_id, entry)
+    return entry
+
+def full_fit_metrics(fitted, fit_seconds=None):
+    return {
+        "fitted_at": datetime.now().isoformat(timespec="seconds"),
+        "trained_from": fitted.fittedvalues.index[0].strftime("%Y-%m-%d"),
+        "fit_seconds": fit_seconds,
+        "aic": round(float(fitted.aic), 4),
+        "baseline_mae": residual_mae(fitted),
+        "updates_since_fit": 0,
+        "update_abs_error": 0.0,
+        "update_obs": 0
+    }
+
+# In-sample MAE, skipping the burn-in period of the diffuse initialisation
+def residual_mae(fitted):
+    resid = fitted.resid.iloc[fitted.loglikelihood_burn:]
+    return round(float(np.abs(resid).mean()), 4) if len(resid) else None
+
+# Order search space: p, q, P, Q in 0..1 with d = D = 1 and weekly seasonality.
+# Without cached candidates the search starts from the same models as a
+# stepwise auto_arima would.
+ORDER_SEASON = 7
+ORDER_MAX = 1
+DEFAULT_ORDER_SEEDS = [((0, 1, 0), (0, 1, 0, ORDER_SEASON)), ((1, 1, 0), (1, 1, 0, ORDER_SEASON)),
+                       ((0, 1, 1), (0, 1, 1, ORDER_SEASON))]
+ORDER_STEPS = [(1, 0, 0, 0), (0, 1, 0, 0), (0, 0, 1, 0), (0, 0, 0, 1), (1, 1, 0, 0), (0, 0, 1, 1)]
+
+def order_neighbours(key):
+    (p, d, q), (P, D, Q, m) = key
+    for dp, dq, dP, dQ in ORDER_STEPS:
+        for sign in (1, -1):
+            values = [p + sign * dp, q + sign * dq, P + sign * dP, Q + sign * dQ]
+            if all(0 <= value <= ORDER_MAX for value in values):
+                yield (values[0], d, values[1]), (values[2], D, values[3], m)
+
+def fit_sarimax(ts, exog, order, seasonal_order):
+    model = SARIMAX(ts, exog=exog, order=order, seasonal_order=seasonal_order,
+                    enforce_stationarity=True, enforce_invertibility=True)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return model.fit(disp=False)
+
+# Fits the candidates, then walks to the best-AIC neighbour until nothing
+# improves or the fit/time budget runs out. The best fit is returned as is,
+# so there's no separate refit of the chosen order.
+def search_order(ts, exog, candidates=(), max_fits=None, budget_s=None):
+    max_fits = ORDER_SEARCH_MAX_FITS if max_fits is None else max_fits
+    budget_s = ORDER_SEARCH_BUDGET_S if budget_s is None else budget_s
+    started = time.perf_counter()
+    tried = set()
+    best = None
+    fits = 0
+
+    def exhausted():
+        return best is not None and (fits >= max_fits or time.perf_counter() - started >= budget_s)
+
+    def attempt(key):
+        nonlocal best, fits
+        tried.add(key)
+        try:
+            fitted = fit_sarimax(ts, exog, *key)
+        except Exception as e:
+            logger.debug(f"SARIMAX{key} failed during order search: {e}")
+            return False
+        finally:
+            fits += 1
+        if np.isfinite(fitted.aic) and (best is None or fitted.aic < best.aic):
+            best = fitted
+            return True
+        return False
+
+    for key in [order_key(*candidate) for candidate in candidates]:
+        if key not in tried and not exhausted():
+            attempt(key)
+    # Also when every cached candidate failed to fit, so a bad cache can't fail training
+    if best is None:
+        for key in DEFAULT_ORDER_SEEDS:
+            if key not in tried and not exhausted():
+                attempt(key)
+    improved = best is not None
+    while improved and not exhausted():
+        improved = False
+        current = order_key(best.model.order, best.model.seasonal_order)
+        for key in order_neighbours(current):
+            if key in tried:
+                continue
+            if exhausted():
+                break
+            if attempt(key):
+                improved = True
+                break
+    if best is None:
+        raise ValueError(f"No SARIMAX order could be fitted after {fits} attempts")
+    return best, {"fits": fits, "seconds": round(time.perf_counter() - started, 3), "warm_start": bool(candidates)}
+
+# Returns the fitted model and a summary of the order search
+def train_model(product_id, data, candidates=()):
+    ts = data["Sales Volume"].fillna(0)
+    exog = data[exog_vars_for(data)]
+
+    if ts[ts > 0].count() < MIN_POSITIVE_OBS:
+        raise ValueError(f"Insufficient data to train SARIMAX for {product_id}")
+
+    fitted, search = search_order(ts, exog, candidates)
+    logger.info(f"Order search for {product_id}: SARIMAX{fitted.model.order}x{fitted.model.seasonal_order} "
+                f"after {search['fits']} fits in {search['seconds']}s (warm start: {search['warm_start']})")
+    return fitted, search
+
+def order_candidates(product_id, data):
+    return ORDER_CACHE.candidates(product_id, *product_groups(data))
+
+def record_order(product_id, data, layout):
+    category, brand = product_groups(data)
+    ORDER_CACHE.put(product_id, {"order": layout["order"], "seasonal_order": layout["seasonal_order"],
+                                 "aic": layout.get("aic"), "category": category, "brand": brand})
+
+# Returns the report row plus the compact artifact (flat array, registry
+# fields); a SARIMAXResults rebuilt from read-only object-store buffers would
+# fail to unpickle, and the compact form is far smaller anyway.
+@ray.remote(num_cpus=1)
+def train_model_task(product_id, data, candidates=()):
+    started = time.perf_counter()
+    try:
+        # Frames fetched from the object store are read-only; statsmodels needs writable buffers
+        fitted, search = train_model(product_id, data.copy(), candidates)
+        fit_seconds = round(time.perf_counter() - started, 3)
+        flat, layout = compact_model(fitted)
+        layout.update(full_fit_metrics(fitted, fit_seconds))
+        return {"product_id": product_id, "status": "trained", "fit_seconds": fit_seconds,
+                "search_fits": search["fits"], "warm_start": search["warm_start"],
+                "baseline_mae": layout["baseline_mae"]}, (flat, layout)
+    except Exception as e:
+        return {"product_id": product_id, "status": "failed", "error": str(e), "fit_seconds": round(time.perf_counter() - started, 3)}, None
+
+# Serialises training of one product across this node's threads and
+# processes. Whoever gets the lock second finds the model on disk.
+_local_training_locks = {}
+_local_training_locks_guard = threading.Lock()
+
+@contextmanager
+def training_lock(product_id):
+    with _local_training_locks_guard:
+        local = _local_training_locks.setdefault(product_id, threading.Lock())
+    with local:
+        os.makedirs(TRAINING_LOCK_DIR, exist_ok=True)
+        with file_lock(os.path.join(TRAINING_LOCK_DIR, f"{checked_product_id(product_id)}.lock")):
+            yield
+
+# Jobs are keyed by product and the registry version the caller saw, so a
+# caller that already has the newer model never joins an old job, and a
+# retrain after invalidation starts a new one. The ref is returned inside a
+# list so Ray hands the caller the ref instead of waiting on it. The first
+# caller for a key is the leader and writes the artifact; the others only
+# read it from the object store. Failed jobs are dropped so the next caller
+# retries.
+@ray.remote(num_cpus=0)
+class TrainingCoordinator:
+    def __init__(self):
+        self.jobs = OrderedDict()
+
+    def train(self, product_id, base_version, data, candidates):
+        key = (product_id, base_version)
+        ref = self.jobs.get(key)
+        if ref is not None and self.failed(ref):
+            ref = None
+        if ref is not None:
+            self.jobs.move_to_end(key)
+            return [ref], False
+        ref = train_model_task.remote(product_id, data[0], candidates)
+        self.jobs[key] = ref
+        while len(self.jobs) > TRAINING_RESULTS_KEPT:
+            self.jobs.popitem(last=False)
+        return [ref], True
+
+    def failed(self, ref):
+        ready, _ = ray.wait([ref], timeout=0)
+        if not ready:
+            return False
+        try:
+            return ray.get(ref)[1] is None
+        except Exception:
+            return True
+
+def training_coordinator():
+    return TrainingCoordinator.options(name=TRAINING_COORDINATOR_NAME, namespace=TRAINING_COORDINATOR_NAMESPACE,
+                                       lifetime="detached", get_if_exists=True).remote()
+
+# Starts (or joins) the product's training through the coordinator.
+# Returns the result ref and whether this caller is the leader.
+def submit_training(coordinator, product_id, data, candidates):
+    base_version = MODEL_REGISTRY.get(product_id)["version"]
+    refs, leader = ray.get(coordinator.train.remote(product_id, base_version, [ray.put(data)], candidates))
+    return refs[0], leader, base_version
+
+# Bulk pre-training: fans train_model out as Ray tasks, keeping at most
+# max_workers in flight, and writes artifacts from the caller so they land in
+# this node's MODEL_DIR. Returns per-product status and fit time; on_result,
+# if given, is called with each product's entry as soon as it is known.
+def train_all_models(partitions, product_ids, max_workers=None, force=False, on_trained=None, on_result=None):
+    if not ray.is_initialized():
+        ray.init(ignore_reinit_error=True)
+    if max_workers is None:
+        max_workers = max(1, int(ray.available_resources().get("CPU", os.cpu_count() or 1)))
+
+    coordinator = training_coordinator()
+    report = {"started_at": datetime.now().isoformat(timespec="seconds"), "products": {}}
+    queue = []
+    for pid in product_ids:
+        if pid not in partitions:
+            report["products"][pid] = {"product_id": pid, "status": "failed", "error": f"No historical data for {pid}"}
+        elif not force and model_exists(pid):
+            report["products"][pid] = {"product_id": pid, "status": "skipped"}
+        else:
+            queue.append(pid)
+            continue
+        if on_result is not None:
+            on_result(pid, report["products"][pid])
+
+    total = len(queue)
+    pending = {}
+    done = 0
+    logger.info(f"Bulk training {total} products with up to {max_workers} workers")
+    while queue or pending:
+        while queue and len(pending) < max_workers:
+            pid = queue.pop(0)
+            # Candidates are looked up at submission, so products queued later
+            # already see the orders picked for their category earlier in the run
+            candidates = order_candidates(pid, partitions[pid])
+            ref, leader, _ = submit_training(coordinator, pid, partitions[pid], candidates)
+            pending[ref] = (pid, leader)
+        ready, _ = ray.wait(list(pending), num_returns=1)
+        for ref in ready:
+            pid, leader = pending.pop(ref)
+            try:
+                result, artifact = ray.get(ref)
+            except Exception as e:
+                result, artifact = {"product_id": pid, "status": "failed", "error": str(e)}, None
+            if artifact is not None:
+                # A follower's model is written by the caller that started the job
+                if leader:
+                    save_model(pid, *artifact)
+                    record_order(pid, partitions[pid], artifact[1])
+                if on_trained is not None:
+                    on_trained(pid)
+            report["products"][pid] = result
+            if on_result is not None:
+                on_result(pid, result)
+            done += 1
+            if result["status"] == "trained":
+                logger.info(f"[{done}/{total}] Trained {pid} in {result['fit_seconds']}s")
+            else:
+                logger.warning(f"[{done}/{total}] Training failed for {pid}: {result.get('error')}")
+
+    statuses = [r["status"] for r in report["products"].values()]
+    report["finished_at"] = datetime.now().isoformat(timespec="seconds")
+    report["summary"] = {status: statuses.count(status) for status in ("trained", "skipped", "failed")}
+    with open(TRAINING_REPORT_PATH, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Bulk training finished: {report['summary']}")
+    return report
+
+# Background bulk training runs keep their state in BULK_JOB_DIR, so any
+# replica can answer a status poll, not just the one running the job.
+def bulk_job_path(job_id):
+    return os.path.join(BULK_JOB_DIR, f"{job_id}.json")
+
+def write_bulk_job(state):
+    os.makedirs(BULK_JOB_DIR, exist_ok=True)
+    path = bulk_job_path(state["job_id"])
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+
+def read_bulk_job(job_id):
+    # Ids are uuid hex; anything else could point outside BULK_JOB_DIR
+    if not job_id.isalnum():
+        return None
+    try:
+        with open(bulk_job_path(job_id)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def rate(numerator, denominator, digits=3):
+    return round(float(numerator) / denominator, digits) if denominator else None
+
+# Error and stockout scores over (cutoffs, horizon) arrays of served
+# forecasts and actual sales, pooled over the given axis (None for all).
+# MAPE skips days without sales; the stockout hit rate is the share of days
+# the actual sales would have run out that the forecast flagged too, both
+# walked down from the same starting stock.
+def backtest_scores(forecasts, actual, stock, axis=None):
+    errors = np.abs(forecasts - actual)
+    sold = actual > 0
+    _, predicted_out = simulate_stock(stock, forecasts)
+    _, actual_out = simulate_stock(stock, actual)
+    stockouts = actual_out.sum(axis=axis)
+    hits = (predicted_out & actual_out).sum(axis=axis)
+    false_alarms = (predicted_out & ~actual_out).sum(axis=axis)
+    ape = np.where(sold, errors / np.where(sold, actual, 1), 0).sum(axis=axis)
+    return errors.mean(axis=axis), ape, sold.sum(axis=axis), stockouts, hits, false_alarms
+
+# Rolling-origin backtest of one product. The product's registered order (or,
+# without a model, the order training would pick) is fitted once on the days
+# before the first cutoff; each later cutoff only filters the days since the
+# previous one through that fit, keeping its parameters, so a product costs
+# one fit and one Kalman filter pass however many cutoffs there are. Each
+# origin forecasts with what /predict would have known then: exog held at
+# the last observed values and the stock remaining at the end of the day
+# before.
+def backtest_product(product_id, data, order=None, seasonal_order=None, candidates=(),
+                     cutoffs=BACKTEST_CUTOFFS, step=BACKTEST_STEP_DAYS, horizon=BACKTEST_HORIZON):
+    started = time.perf_counter()
+    ts = data["Sales Volume"].fillna(0)
+    exog = data[exog_vars_for(data)]
+    first = len(ts) - horizon - (cutoffs - 1) * step
+    if first <= 0 or (ts.iloc[:first] > 0).sum() < MIN_POSITIVE_OBS:
+        raise ValueError(f"Insufficient history to backtest {product_id} over {cutoffs} cutoffs")
+
+    if order is not None:
+        fitted = fit_sarimax(ts.iloc[:first], exog.iloc[:first], tuple(order), tuple(seasonal_order))
+    else:
+        fitted, _ = search_order(ts.iloc[:first], exog.iloc[:first], candidates)
+    fit_seconds = round(time.perf_counter() - started, 3)
+
+    origins = first + step * np.arange(cutoffs)
+    exog_values = exog.to_numpy(dtype=float)
+    forecasts = np.empty((cutoffs, horizon))
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for k, origin in enumerate(origins):
+            if k:
+                fitted = fitted.extend(ts.iloc[origin - step:origin], exog=exog.iloc[origin - step:origin])
+            held = np.repeat(exog_values[origin - 1:origin], horizon, axis=0)
+            forecasts[k] = np.asarray(fitted.forecast(steps=horizon, exog=held))
+    # Scored as served: clipped at zero and rounded to whole units
+    forecasts = np.round(np.clip(forecasts, 0, None))
+    actual = ts.to_numpy(dtype=float)[origins[:, None] + np.arange(horizon)]
+    stock = data["Remaining Stock Level"].ffill().fillna(0).to_numpy(dtype=float)[origins - 1]
+
+    by_horizon = backtest_scores(forecasts, actual, stock, axis=0)
+    horizons = [{"horizon": h + 1, "mae": round(float(mae), 2), "mape": rate(100 * ape, sold, 2),
+                 "stockouts": int(stockouts), "stockout_hits": int(hits), "false_alarms": int(false_alarms),
+                 "stockout_hit_rate": rate(hits, stockouts)}
+                for h, (mae, ape, sold, stockouts, hits, false_alarms) in enumerate(zip(*by_horizon))]
+    mae, ape, sold, stockouts, hits, false_alarms = backtest_scores(forecasts, actual, stock)
+    return {"product_id": product_id, "status": "backtested",
+            "order": list(fitted.model.order), "seasonal_order": list(fitted.model.seasonal_order),
+            "cutoffs": [d.strftime("%Y-%m-%d") for d in ts.index[origins]],
+            "mae": round(float(mae), 2), "mape": rate(100 * ape, sold, 2),
+            "stockouts": int(stockouts), "stockout_hits": int(hits), "false_alarms": int(false_alarms),
+            "stockout_hit_rate": rate(hits, stockouts), "horizons": horizons,
+            "fit_seconds": fit_seconds, "seconds": round(time.perf_counter() - started, 3)}
+
+@ray.remote(num_cpus=1)
+def backtest_task(product_id, data, order, seasonal_order, candidates, cutoffs, step, horizon):
+    try:
+        # Frames fetched from the object store are read-only; statsmodels needs writable buffers
+        return backtest_product(product_id, data.copy(), order, seasonal_order, candidates, cutoffs, step, horizon)
+    except Exception as e:
+        return {"product_id": product_id, "status": "failed", "error": str(e)}
+
+# Catalog-wide scores per horizon: MAE and MAPE averaged over products,
+# stockout counts pooled
+def backtest_summary(results, horizon):
+    done = [r for r in results if r["status"] == "backtested"]
+    summary = {"backtested": len(done), "failed": len(results) - len(done)}
+
+    def pooled(rows):
+        mapes = [r["mape"] for r in rows if r["mape"] is not None]
+        stockouts = sum(r["stockouts"] for r in rows)
+        hits = sum(r["stockout_hits"] for r in rows)
+        return {"mae": round(float(np.mean([r["mae"] for r in rows])), 2) if rows else None,
+                "mape": round(float(np.mean(mapes)), 2) if mapes else None,
+                "stockouts": stockouts, "stockout_hits": hits,
+                "false_alarms": sum(r["false_alarms"] for r in rows),
+                "stockout_hit_rate": rate(hits, stockouts)}
+
+    summary.update(pooled(done))
+    summary["horizons"] = [{"horizon": h + 1, **pooled([r["horizons"][h] for r in done])} for h in range(horizon)]
+    return summary
+
+# Backtests products in parallel Ray tasks, one per product, and writes the
+# report to BACKTEST_REPORT_PATH (replaced atomically, as GET /backtest may
+# be reading it)
+def run_backtest(partitions, product_ids, max_workers=None, cutoffs=BACKTEST_CUTOFFS,
+                 step=BACKTEST_STEP_DAYS, horizon=BACKTEST_HORIZON):
+    if not ray.is_initialized():
+        ray.init(ignore_reinit_error=True)
+    if max_workers is None:
+        max_workers = max(1, int(ray.available_resources().get("CPU", os.cpu_count() or 1)))
+
+    report = {"started_at": datetime.now().isoformat(timespec="seconds"),
+              "config": {"cutoffs": cutoffs, "step_days": step, "horizon": horizon}, "products": {}}
+    queue = []
+    for pid in product_ids:
+        if pid in partitions:
+            queue.append(pid)
+        else:
+            report["products"][pid] = {"product_id": pid, "status": "failed", "error": f"No historical data for {pid}"}
+
+    total = len(queue)
+    pending = {}
+    done = 0
+    logger.info(f"Backtesting {total} products over {cutoffs} cutoffs with up to {max_workers} workers")
+    while queue or pending:
+        while queue and len(pending) < max_workers:
+            pid = queue.pop(0)
+            entry = MODEL_REGISTRY.get(pid)
+            candidates = () if "order" in entry else order_candidates(pid, partitions[pid])
+            ref = backtest_task.remote(pid, partitions[pid], entry.get("order"), entry.get("seasonal_order"),
+                                       candidates, cutoffs, step, horizon)
+            pending[ref] = pid
+        ready, _ = ray.wait(list(pending), num_returns=1)
+        for ref in ready:
+            pid = pending.pop(ref)
+            try:
+                result = ray.get(ref)
+            except Exception as e:
+                result = {"product_id": pid, "status": "failed", "error": str(e)}
+            report["products"][pid] = result
+            done += 1
+            if result["status"] == "backtested":
+                logger.info(f"[{done}/{total}] Backtested {pid} in {result['seconds']}s: MAE {result['mae']}")
+            else:
+                logger.warning(f"[{done}/{total}] Backtest failed for {pid}: {result.get('error')}")
+
+    report["finished_at"] = datetime.now().isoformat(timespec="seconds")
+    report["summary"] = backtest_summary(list(report["products"].values()), horizon)
+    tmp = BACKTEST_REPORT_PATH + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp, BACKTEST_REPORT_PATH)
+    logger.info(f"Backtest finished: {report['summary']['backtested']} products, "
+                f"MAE {report['summary']['mae']}, MAPE {report['summary']['mape']}")
+    return report
 
 # Pydantic models
 class PredictionRequest(BaseModel):
     product_id: str
     start_date: str
     end_date: str
+    include_plot: bool = False
+    include_probability: bool = False
+
+class BatchPredictionRequest(BaseModel):
+    items: list[PredictionRequest]
+
+class TrainAllRequest(BaseModel):
+    product_ids: list[str] | None = None
+    force: bool = False
+    max_workers: int | None = None
+
+class BacktestRequest(BaseModel):
+    product_ids: list[str] | None = None
+    max_workers: int | None = None
+    cutoffs: int = BACKTEST_CUTOFFS
+    step_days: int = BACKTEST_STEP_DAYS
+    horizon: int = BACKTEST_HORIZON
 
 class NewDataRequest(BaseModel):
     product_id: str
@@ -114,55 +1971,317 @@ app.add_middleware(
     allow_headers=["*"]
 )
 
-@serve.deployment(name="ForecastingService", num_replicas=1)
+class ServiceOverloaded(Exception):
+    pass
+
+DEPLOYMENT_OPTIONS = {
+    "max_ongoing_requests": MAX_ONGOING_REQUESTS,
+    "ray_actor_options": {"num_cpus": REPLICA_NUM_CPUS}
+}
+if NUM_REPLICAS == "auto":
+    DEPLOYMENT_OPTIONS["autoscaling_config"] = {
+        "min_replicas": AUTOSCALE_MIN_REPLICAS,
+        "max_replicas": AUTOSCALE_MAX_REPLICAS,
+        "target_ongoing_requests": AUTOSCALE_TARGET_ONGOING_REQUESTS
+    }
+else:
+    DEPLOYMENT_OPTIONS["num_replicas"] = int(NUM_REPLICAS)
+
+@serve.deployment(name="ForecastingService", **DEPLOYMENT_OPTIONS)
 @serve.ingress(app)
 class ForecastingService:
     def __init__(self):
-        self.df = df
-        self.product_ids = PRODUCT_IDS
+        self.metrics = ServiceMetrics()
+        self.profiler = SamplingProfiler()
+        self.partitions = PartitionStore(load_store())
+        base = self.partitions.frame
+        # Sorted for listing; membership checks go through the set
+        self.product_ids = sorted(self.partitions)
+        self.product_set = frozenset(self.product_ids)
+        self.exog_vars = exog_vars_for(base)
         self.fitted_models = {}
+        self.training_coordinator = None
+        self.forecast_cache = ForecastCache(FORECAST_CACHE_SIZE, FORECAST_CACHE_TTL_S)
+        # Dates ingested per product while its training was running
+        self.missed_dates = {}
+        self.training_scheduler = TrainingScheduler(self.train_scheduled, TRAINING_WORKERS)
+        # Id of the bulk training run this replica is executing, if any
+        self.bulk_job = None
+        self.bulk_lock = threading.Lock()
+        self.plot_executor = ThreadPoolExecutor(max_workers=PLOT_WORKERS, thread_name_prefix="plot")
+        self.cpu_executor = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix="cpu")
+        self.cpu_pending = 0
+        self.ingest_lock = threading.Lock()
+        self.ingest_log = IngestLog(INGEST_LOG_PATH, CHECKPOINT_PATH, DATA_PATH)
+        replayed = self.ingest_log.replay()
+        self.compact_requested = threading.Event()
+        for product_id, rows in (replayed.groupby("product_id", sort=False) if not replayed.empty else []):
+            self.partitions[product_id] = append_to_partition(self.partitions.get(product_id), rows)
+        self.date_min = base.index.min() if not base.empty else None
+        self.date_max = base.index.max() if not base.empty else None
+        if not replayed.empty:
+            self.date_min = min(filter(pd.notna, [self.date_min, replayed["Date"].min()]))
+            self.date_max = max(filter(pd.notna, [self.date_max, replayed["Date"].max()]))
+        logger.info(f"Built partitioned store for {len(self.partitions)} products "
+                    f"({base.memory_usage(deep=True).sum() / 2**20:.1f} MiB)")
+        started = time.perf_counter()
+        self.fallback = FallbackForecaster(FALLBACK_WEEKS, FALLBACK_ALPHA)
+        self.fallback.build(self.partitions)
+        logger.info(f"Built fallback forecasts for {len(self.fallback.rows)} products "
+                    f"in {time.perf_counter() - started:.2f}s")
+        threading.Thread(target=self.compaction_loop, name="ingest-compaction", daemon=True).start()
+
+    def compaction_loop(self):
+        while True:
+            self.compact_requested.wait(COMPACT_INTERVAL_S)
+            self.compact_requested.clear()
+            try:
+                self.compact()
+            except Exception as e:
+                logger.error(f"Ingestion log compaction failed: {e}")
 
+    # Folds every replica's logged rows into DATA_PATH, not only this one's
+    def compact(self):
+        rows, seq = self.ingest_log.compact(write_base, publish_ingested)
+        if rows:
+            logger.info(f"Compacted {rows} ingested rows into {DATA_PATH} (seq {seq})")
+
+    # Runs fn on the CPU pool without blocking the event loop. The timeout only
+    # bounds how long the request waits; the job itself runs to completion and
+    # still populates the model and forecast caches, and counts against
+    # MAX_PENDING_CPU_TASKS until it finishes.
+    async def run_cpu(self, fn, *args):
+        if self.cpu_pending >= MAX_PENDING_CPU_TASKS:
+            raise ServiceOverloaded(f"Server busy: {self.cpu_pending} jobs queued, try again later")
+        self.cpu_pending += 1
+        try:
+            future = asyncio.get_running_loop().run_in_executor(self.cpu_executor, fn, *args)
+        except Exception:
+            self.cpu_pending -= 1
+            raise
+        future.add_done_callback(self.cpu_job_done)
+        return await asyncio.wait_for(asyncio.shield(future), REQUEST_TIMEOUT_S)
+
+    # Runs on the event loop when the job ends, whether or not its request is
+    # still waiting
+    def cpu_job_done(self, future):
+        self.cpu_pending -= 1
+        if not future.cancelled():
+            # Marks the error retrieved for jobs whose request already timed out
+            future.exception()
+
+    def overload_response(self, e):
+        if isinstance(e, ServiceOverloaded):
+            logger.warning(str(e))
+            return JSONResponse(content={"error": str(e)}, status_code=503)
+        logger.warning(f"Request timed out after {REQUEST_TIMEOUT_S}s")
+        return JSONResponse(content={"error": f"Timed out after {REQUEST_TIMEOUT_S}s"}, status_code=504)
+
+    def get_partition(self, product_id):
+        partition = self.partitions.get(product_id)
+        if partition is None:
+            raise ValueError(f"No historical data for {product_id}")
+        return partition
+
+    def load_saved_model(self, product_id):
+        entry = MODEL_REGISTRY.get(product_id)
+        if os.path.exists(model_path_for(product_id)) and "tail_len" in entry:
+            logger.info(f"Loading cached model for {product_id} (version {entry['version']})")
+            self.metrics.model_lookups.labels("disk").inc()
+            return load_compact_model(entry)
+        return None
+
+    # Training and legacy conversion run under the product's training lock;
+    # a caller that waited on it loads what the holder wrote instead
     def load_or_train_model(self, product_id):
-        model_path = os.path.join(MODEL_DIR, f"sarima_{product_id}.pkl")
+        fitted = self.load_saved_model(product_id)
+        if fitted is not None:
+            return fitted
+        with training_lock(product_id):
+            fitted = self.load_saved_model(product_id)
+            if fitted is not None:
+                return fitted
 
-        if os.path.exists(model_path):
-            logger.info(f"Loading cached model for {product_id}")
-            return joblib.load(model_path)
+            legacy_path = legacy_model_path_for(product_id)
+            if os.path.exists(legacy_path):
+                logger.info(f"Converting legacy pickled model for {product_id}")
+                fitted = joblib.load(legacy_path)
+                flat, layout = compact_model(fitted)
+                save_model(product_id, flat, layout, **full_fit_metrics(fitted))
+                os.remove(legacy_path)
+                return load_compact_model(MODEL_REGISTRY.get(product_id))
+            return self.train_new_model(product_id)
 
+    @timed_stage("train")
+    def train_new_model(self, product_id):
+        self.metrics.model_lookups.labels("trained").inc()
         logger.info(f"Training new SARIMAX model for {product_id}")
-        data = self.df[self.df["product_id"] == product_id]
-        ts = data[["Date", "Sales Volume"]].set_index("Date").resample("D").sum().asfreq("D").fillna(method="ffill")["Sales Volume"]
-        exog = data[EXOG_VARS].set_index(data["Date"]).resample("D").asfreq().fillna(method="ffill")
+        partition = self.get_partition(product_id)
+        candidates = order_candidates(product_id, partition)
+        if ray.is_initialized():
+            # Fit in a Ray worker process so training doesn't hold this replica's
+            # GIL, joining any training of this product already running elsewhere
+            if self.training_coordinator is None:
+                self.training_coordinator = training_coordinator()
+            ref, leader, base_version = submit_training(self.training_coordinator, product_id, partition, candidates)
+            result, artifact = ray.get(ref)
+            if artifact is None:
+                raise ValueError(result["error"])
+            flat, layout = artifact
+            if not leader:
+                logger.info(f"Using model for {product_id} trained by another caller")
+                return load_compact_model({**layout, "product_id": product_id, "version": base_version + 1}, flat)
+        else:
+            started = time.perf_counter()
+            fitted, _ = train_model(product_id, partition, candidates)
+            flat, layout = compact_model(fitted)
+            layout.update(full_fit_metrics(fitted, round(time.perf_counter() - started, 3)))
+        entry = save_model(product_id, flat, layout)
+        record_order(product_id, partition, layout)
+        return load_compact_model(entry)
+
+    def on_model_trained(self, product_id):
+        self.fitted_models.pop(product_id, None)
+        self.forecast_cache.invalidate(product_id)
 
-        if ts[ts > 0].count() < 14:
-            raise ValueError(f"Insufficient data to train SARIMAX for {product_id}")
+    def get_model(self, product_id):
+        if product_id in self.fitted_models:
+            self.metrics.model_lookups.labels("memory").inc()
+        else:
+            self.fitted_models[product_id] = self.load_or_train_model(product_id)
+        return self.fitted_models[product_id]
+
+    # Body of a scheduler job. A fit reads the partition when it starts, so
+    # rows ingested while it ran are folded in afterwards (or trigger a full
+    # retrain, as update_model decides) instead of being left out until the
+    # next refit.
+    def train_scheduled(self, product_id):
+        try:
+            self.get_model(product_id)
+        except Exception:
+            # The next fit reads the whole partition anyway
+            self.missed_dates.pop(product_id, None)
+            raise
+        with self.ingest_lock:
+            missed = self.missed_dates.pop(product_id, None)
+            status = self.update_model(product_id, missed) if missed else "none"
+            if missed:
+                self.forecast_cache.invalidate(product_id)
+        if status == "invalidated":
+            self.get_model(product_id)
+
+    # True when forecasting won't have to train first
+    def model_ready(self, product_id):
+        return product_id in self.fitted_models or model_exists(product_id)
+
+    def data_poor(self, product_id):
+        sales = self.get_partition(product_id)["Sales Volume"]
+        return int((sales > 0).sum()) < MIN_POSITIVE_OBS
+
+    # Prediction from the fallback forecaster, with the same stock simulation
+    # and MAE as a model-based one
+    def fallback_result(self, product_id, start_date, end_date):
+        dates = pd.date_range(start=start_date, end=end_date)
+        with self.metrics.stage("fallback"):
+            forecast_df = pd.DataFrame({"product_id": product_id, "Date": dates,
+                                        "Forecasted Demand": self.fallback.forecast(product_id, dates)})
+        result = self.detect_stockout(product_id, forecast_df)
+        result["mae"] = self.calc_mae(product_id, forecast_df, start_date, end_date)
+        result["fallback"] = True
+        return result
+
+    def job_response(self, job_id, job):
+        content = {"job_id": job_id, "status": job["status"], "poll": f"/jobs/{job_id}"}
+        if job["status"] == "failed":
+            content["error"] = job["error"]
+            content["retry_at"] = datetime.fromtimestamp(job["retry_at"]).isoformat(timespec="seconds")
+            return JSONResponse(content=content)
+        content["priority"] = PRIORITY_NAMES[job["priority"]]
+        content["queued_at"] = datetime.fromtimestamp(job["queued_at"]).isoformat(timespec="seconds")
+        if job["started_at"] is not None:
+            content["started_at"] = datetime.fromtimestamp(job["started_at"]).isoformat(timespec="seconds")
+        return JSONResponse(content=content, status_code=202)
+
+    def model_version(self, product_id):
+        return MODEL_REGISTRY.get(product_id)["version"]
 
-        auto_model = auto_arima(ts, exog=exog, seasonal=True, m=7, start_p=0, max_p=1, start_q=0, max_q=1,
-                                start_P=0, max_P=1, start_Q=0, max_Q=1, d=1, D=1,
-                                stepwise=True, suppress_warnings=True, trace=False)
+    def invalidate_model(self, product_id):
+        for path in (model_path_for(product_id), legacy_model_path_for(product_id)):
+            if os.path.exists(path):
+                os.remove(path)
+        self.fitted_models.pop(product_id, None)
 
-        model = SARIMAX(ts, exog=exog, order=auto_model.order, seasonal_order=auto_model.seasonal_order,
-                        enforce_stationarity=True, enforce_invertibility=True)
-        fitted = model.fit(disp=False)
-        joblib.dump(fitted, model_path)
+    # Extends the product's fitted model with observations newer than its last
+    # training date by re-running the filter with the fitted parameters. Falls
+    # back to invalidation (full retrain on next read) when the new rows are
+    # not strictly after the model's sample, on the refit schedule, or on drift.
+    # Returns "none", "updated" or "invalidated".
+    def update_model(self, product_id, new_dates):
+        if product_id not in self.fitted_models and not model_exists(product_id):
+            return "none"
+        fitted = self.get_model(product_id)
+
+        meta = MODEL_REGISTRY.get(product_id)
+        model_end = fitted.fittedvalues.index[-1]
+        if min(new_dates) <= model_end:
+            logger.info(f"New data for {product_id} overlaps the model sample; full retrain required")
+            self.invalidate_model(product_id)
+            return "invalidated"
+        if meta.get("updates_since_fit", 0) + 1 >= FULL_REFIT_EVERY:
+            logger.info(f"Scheduled full retrain for {product_id} after {meta['updates_since_fit'] + 1} updates")
+            self.invalidate_model(product_id)
+            return "invalidated"
+
+        new_data = self.get_partition(product_id).loc[model_end + pd.Timedelta(days=1):]
+        new_ts = new_data["Sales Volume"].fillna(0)
+        new_exog = new_data[self.exog_vars]
+
+        # Drift check: error of the current model on the data it is about to absorb
+        predicted = fitted.forecast(steps=len(new_ts), exog=new_exog)
+        abs_error = meta.get("update_abs_error", 0.0) + float(np.abs(predicted.values - new_ts.values).sum())
+        update_obs = meta.get("update_obs", 0) + len(new_ts)
+        baseline = meta.get("baseline_mae")
+        if baseline and update_obs >= DRIFT_MIN_OBS and abs_error / update_obs > DRIFT_THRESHOLD * baseline:
+            logger.info(f"Drift detected for {product_id}: MAE {abs_error / update_obs:.2f} vs baseline {baseline:.2f}")
+            self.invalidate_model(product_id)
+            return "invalidated"
+
+        fitted = fitted.append(new_ts, exog=new_exog, copy_initialization=True)
+        flat, layout = compact_model(fitted)
+        entry = save_model(product_id, flat, layout,
+                           updates_since_fit=meta.get("updates_since_fit", 0) + 1,
+                           update_abs_error=abs_error, update_obs=update_obs)
         self.fitted_models[product_id] = fitted
-        return fitted
+        logger.info(f"Incrementally updated model for {product_id} to version {entry['version']}")
+        return "updated"
+
+    @timed_stage("exog")
+    def future_exog(self, product_id, dates):
+        return self.get_partition(product_id)[self.exog_vars].reindex(dates, method="ffill")
+
+    # Monte Carlo stockout risk for [start_date, end_date]: demand paths drawn
+    # from the model's forecast distribution, walked through simulate_stock
+    # from the same starting stock as the point forecast.
+    def stockout_probability(self, product_id, start_date, end_date, forecast_df):
+        fitted = self.get_model(product_id)
+        dates = pd.date_range(start=start_date, end=end_date)
+        paths = sample_demand_paths(fitted, len(dates), self.future_exog(product_id, dates), MONTE_CARLO_PATHS)
+        starting_stock = self.stock_levels(product_id, forecast_df)["Remaining Stock Level"].iloc[0]
+        return stockout_risk(starting_stock, paths, dates)
 
     def forecast(self, product_id, start_date, end_date):
-        if product_id not in self.product_ids:
+        if product_id not in self.product_set:
             raise ValueError("Invalid product_id")
 
-        if product_id not in self.fitted_models:
-            self.fitted_models[product_id] = self.load_or_train_model(product_id)
+        fitted = self.get_model(product_id)
 
         forecast_days = (pd.to_datetime(end_date) - pd.to_datetime(start_date)).days + 1
         dates = pd.date_range(start=start_date, end=end_date)
         
-        data = self.df[self.df["product_id"] == product_id]
-        exog_future = data[EXOG_VARS].set_index(data["Date"]).resample("D").asfreq().fillna(method="ffill")
-        exog_future = exog_future.reindex(dates, method="ffill")
+        exog_future = self.future_exog(product_id, dates)
         
-        forecast_vals = self.fitted_models[product_id].forecast(steps=forecast_days, exog=exog_future)
+        with self.metrics.stage("forecast"):
+            forecast_vals = fitted.forecast(steps=forecast_days, exog=exog_future)
         forecast_vals = np.clip(forecast_vals, 0, None)
         forecast_vals = np.round(forecast_vals).astype(int)
 
@@ -172,17 +2291,16 @@ class ForecastingService:
             "Forecasted Demand": forecast_vals
         })
 
-    def detect_stockout(self, product_id, forecast_df):
-        history = self.df[self.df["product_id"] == product_id]
-        if history.empty:
-            raise ValueError(f"No historical data for {product_id}")
+    # Forecast frame joined with the stock levels on each forecast date,
+    # falling back to the latest known levels outside the history
+    @timed_stage("data_slice")
+    def stock_levels(self, product_id, forecast_df):
+        history = self.get_partition(product_id)
 
         start_date = forecast_df["Date"].min()
         end_date = forecast_df["Date"].max()
         
-        inventory = history[["Date", "Opening Stock Level", "Remaining Stock Level"]].set_index("Date")
-        inventory = inventory.resample("D").asfreq().fillna(method="ffill").reset_index()
-        inventory = inventory[(inventory["Date"] >= start_date) & (inventory["Date"] <= end_date)]
+        inventory = history.loc[start_date:end_date, ["Opening Stock Level", "Remaining Stock Level"]].reset_index()
 
         if inventory.empty:
             latest_stock = history["Opening Stock Level"].iloc[-1] if not history["Opening Stock Level"].empty else 0
@@ -201,77 +2319,278 @@ class ForecastingService:
         latest_remaining = history["Remaining Stock Level"].iloc[-1] if not history["Remaining Stock Level"].empty else 0
         merged["Opening Stock Level"] = merged["Opening Stock Level"].fillna(latest_stock)
         merged["Remaining Stock Level"] = merged["Remaining Stock Level"].fillna(latest_remaining)
+        return merged
 
+    def detect_stockout(self, product_id, forecast_df):
+        return self.stockout_result(product_id, self.stock_levels(product_id, forecast_df))
+
+    # Stock levels that make the simulation meaningless, judged over the
+    # whole range: "opening", "remaining" or None
+    @staticmethod
+    def invalid_stock(merged):
         if merged["Opening Stock Level"].isna().any() or (merged["Opening Stock Level"] <= 0).all():
+            return "opening"
+        if merged["Remaining Stock Level"].isna().any() or (merged["Remaining Stock Level"] < 0).any():
+            return "remaining"
+        return None
+
+    # Stockout simulation over a stock_levels frame
+    def stockout_result(self, product_id, merged):
+        merged = merged.copy()
+        invalid = self.invalid_stock(merged)
+
+        if invalid == "opening":
             logger.warning(f"Invalid Opening Stock Levels for {product_id}: {merged['Opening Stock Level'].tolist()}")
             return {
                 "error": f"Invalid or zero Opening Stock Levels for {product_id}. Please update the dataset.",
                 "dates": [], "forecasted_demand": [],
                 "current_stock_level": [], "remaining_stock_level": [],
                 "stockout": []
-            }, ""
+            }
 
-        if merged["Remaining Stock Level"].isna().any() or (merged["Remaining Stock Level"] < 0).any():
+        if invalid == "remaining":
             logger.warning(f"Invalid remaining stock levels for {product_id}: {merged['Remaining Stock Level'].tolist()}")
             return {
                 "error": f"Invalid remaining stock levels for {product_id}. Please update the dataset.",
                 "dates": [], "forecasted_demand": [],
                 "current_stock_level": [], "remaining_stock_level": [],
                 "stockout": []
-            }, ""
+            }
+
+        with self.metrics.stage("stockout"):
+            simulated_remaining_stock, stockout_flags = simulate_stock(
+                merged["Remaining Stock Level"].iloc[0], merged["Forecasted Demand"].to_numpy())
+
+            merged["Remaining Stock Level"] = simulated_remaining_stock
+            merged["Stockout"] = stockout_flags
+            merged["Date"] = merged["Date"].dt.strftime("%Y-%m-%d")
 
-        simulated_remaining_stock = []
-        stockout_flags = []
-        remaining = merged["Remaining Stock Level"].iloc[0]
+            # Formatting the frame costs more than the simulation, so only when asked for
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Merged DataFrame for {product_id}:\n{merged[['Date', 'Opening Stock Level', 'Remaining Stock Level', 'Forecasted Demand', 'Stockout']].to_string()}")
 
-        for demand in merged["Forecasted Demand"]:
-            stockout_flags.append(remaining - demand < 0)
-            remaining = max(0, remaining - demand)
-            remaining = round(remaining)
-            simulated_remaining_stock.append(remaining)
+            return {
+                "dates": merged["Date"].tolist(),
+                "forecasted_demand": merged["Forecasted Demand"].tolist(),
+                "current_stock_level": merged["Opening Stock Level"].astype(int).tolist(),
+                "remaining_stock_level": merged["Remaining Stock Level"].astype(int).tolist(),
+                "stockout": merged["Stockout"].tolist()
+            }
 
-        merged["Remaining Stock Level"] = simulated_remaining_stock
-        merged["Stockout"] = stockout_flags
-        merged["Date"] = merged["Date"].dt.strftime("%Y-%m-%d")
+    # Renders the plot for [start_date, end_date] as PNG bytes, reusing the
+    # copy cached on the forecast cache entry when there is one
+    def plot_png(self, product_id, start_date, end_date):
+        _, result, entry = self.cached_prediction(product_id, start_date, end_date)
+        if "error" in result:
+            raise ValueError(result["error"])
+        plot_key = pd.to_datetime(end_date)
+        if plot_key not in entry["plots"]:
+            entry["plots"][plot_key] = self.result_plot_png(product_id, result)
+        return entry["plots"][plot_key]
 
-        logger.info(f"Merged DataFrame for {product_id}:\n{merged[['Date', 'Opening Stock Level', 'Remaining Stock Level', 'Forecasted Demand', 'Stockout']].to_string()}")
+    # Plot of the fallback forecast, for products without a ready model
+    def fallback_plot_png(self, product_id, start_date, end_date):
+        result = self.fallback_result(product_id, start_date, end_date)
+        if "error" in result:
+            raise ValueError(result["error"])
+        return self.result_plot_png(product_id, result)
 
-        return {
-            "dates": merged["Date"].tolist(),
-            "forecasted_demand": merged["Forecasted Demand"].tolist(),
-            "current_stock_level": merged["Opening Stock Level"].astype(int).tolist(),
-            "remaining_stock_level": merged["Remaining Stock Level"].astype(int).tolist(),
-            "stockout": merged["Stockout"].tolist()
-        }, self.plot_graph(merged, product_id)
-
-    def plot_graph(self, df, product_id):
-        plt.figure(figsize=(10, 4))
-        plt.plot(df["Date"], df["Forecasted Demand"], label="Forecasted Demand", marker="o")
-        plt.plot(df["Date"], df["Opening Stock Level"], label="Opening Stock Level", marker="x")
-        plt.plot(df["Date"], df["Remaining Stock Level"], label="Remaining Stock Level", marker="s")
-        plt.fill_between(df["Date"], 0, df["Forecasted Demand"], where=df["Stockout"], color="red", alpha=0.3, label="Stock-out Risk")
-        plt.title(f"Demand vs Stock - {product_id}")
-        plt.xlabel("Date")
-        plt.ylabel("Units")
-        plt.xticks(rotation=45)
-        plt.legend()
-        plt.tight_layout()
-
-        buf = io.BytesIO()
-        plt.savefig(buf, format="png")
-        plt.close()
-        buf.seek(0)
-        return base64.b64encode(buf.read()).decode("utf-8")
+    def result_plot_png(self, product_id, result):
+        with self.metrics.stage("plot"):
+            return render_plot_png(pd.DataFrame({
+                "Date": result["dates"],
+                "Forecasted Demand": result["forecasted_demand"],
+                "Opening Stock Level": result["current_stock_level"],
+                "Remaining Stock Level": result["remaining_stock_level"],
+                "Stockout": result["stockout"]
+            }), product_id)
 
+    @timed_stage("mae")
     def calc_mae(self, product_id, forecast_df, start_date, end_date):
-        actual = self.df[(self.df["product_id"] == product_id) & (self.df["Date"] >= start_date) & (self.df["Date"] <= end_date)][["Date", "Sales Volume"]]
-        actual["Date"] = pd.to_datetime(actual["Date"])
+        actual = self.get_partition(product_id).loc[start_date:end_date, ["Sales Volume"]].dropna().reset_index()
         merged = forecast_df.merge(actual, on="Date", how="inner")
         if merged.empty:
             return None
         merged["abs_error"] = (merged["Forecasted Demand"] - merged["Sales Volume"]).abs()
         return round(merged["abs_error"].mean(), 2)
 
+    def validate_range(self, start_date, end_date):
+        start_date = pd.to_datetime(start_date)
+        end_date = pd.to_datetime(end_date)
+        if start_date > end_date:
+            raise ValueError("start_date must be before end_date")
+        if self.date_min is None or start_date < self.date_min or end_date > self.date_max + pd.Timedelta(days=365):
+            raise ValueError("Date range outside available data")
+        return start_date, end_date
+
+    # Validates one /add_data row as /add_data_batch does and applies it as a
+    # batch of one
+    def ingest_row(self, req):
+        row = {"product_id": req.product_id, "Date": pd.to_datetime(req.date), "Sales Volume": req.sales_volume,
+               "Opening Stock Level": req.opening_stock_level, "Remaining Stock Level": req.remaining_stock_level}
+        for var in self.exog_vars:
+            row[var] = getattr(req, var, None)
+        frame, errors = validate_ingest_rows(pd.DataFrame([row]), self.exog_vars)
+        if errors:
+            raise ValueError(errors[0]["error"])
+        return self.ingest_frame(frame)[frame["product_id"].iloc[0]]
+
+    # Fills in the columns a new row doesn't carry from the product's latest
+    # partition row: Reorder Point and Lead Time always, exog variables when
+    # the row leaves them empty; 0 for products without history.
+    def complete_rows(self, frame):
+        carried = ["Reorder Point", "Lead Time (Days)"] + self.exog_vars
+        latest = {}
+        for product_id in frame["product_id"].unique():
+            partition = self.partitions.get(product_id)
+            if partition is not None and not partition.empty:
+                latest[product_id] = partition.iloc[-1].reindex(carried)
+        latest = pd.DataFrame.from_dict(latest, orient="index", columns=carried) if latest \
+            else pd.DataFrame(columns=carried, dtype=float)
+        previous = latest.reindex(frame["product_id"].to_numpy()).set_axis(frame.index)
+        frame = frame.copy()
+        for col in carried:
+            values = pd.to_numeric(previous[col], errors="coerce").fillna(0)
+            frame[col] = pd.to_numeric(frame[col], errors="coerce").fillna(values) if col in frame.columns else values
+        return frame[["product_id", "Date"] + list(INGEST_COLUMNS.values())[2:] + carried]
+
+    # Applies a batch of new rows as one unit: a single ingestion log record,
+    # then each affected product's partition, model and cached forecasts are
+    # updated once. Serialised by ingest_lock since it mutates shared state.
+    # Returns the model status ("none", "updated", "invalidated") per product.
+    @timed_stage("ingest")
+    def ingest_frame(self, frame):
+        # Nothing reaches the log with an id that can't be a file name, since
+        # logged rows are replayed on every start
+        for product_id in frame["product_id"].unique():
+            checked_product_id(product_id)
+        with self.ingest_lock:
+            frame = self.complete_rows(frame)
+            self.ingest_log.append(frame)
+            if self.ingest_log.pending >= COMPACT_MAX_RECORDS:
+                self.compact_requested.set()
+            batch_min, batch_max = frame["Date"].min(), frame["Date"].max()
+            self.date_min = batch_min if self.date_min is None else min(self.date_min, batch_min)
+            self.date_max = batch_max if self.date_max is None else max(self.date_max, batch_max)
+
+            statuses = {}
+            for product_id, rows in frame.groupby("product_id", sort=False):
+                self.partitions[product_id] = append_to_partition(self.partitions.get(product_id), rows)
+                try:
+                    statuses[product_id] = self.update_model(product_id, list(rows["Date"]))
+                except Exception as e:
+                    # The rows are already logged; drop the model so it retrains on them
+                    logger.error(f"Model update failed for {product_id}, invalidating: {e}")
+                    self.invalidate_model(product_id)
+                    statuses[product_id] = "invalidated"
+                self.forecast_cache.invalidate(product_id)
+                job = self.training_scheduler.status(product_id)
+                if statuses[product_id] == "none" and job is not None and job["status"] == "running":
+                    self.missed_dates.setdefault(product_id, []).extend(rows["Date"])
+                # Retrain in the background once the burst of new rows settles
+                if statuses[product_id] == "invalidated" or job is not None:
+                    self.training_scheduler.schedule(product_id, PRIORITY_STALE, RETRAIN_DEBOUNCE_S, retry=True)
+            self.fallback.update(self.partitions, list(statuses))
+            return statuses
+
+    # Parses and validates an /add_data_batch body; with skip_invalid the valid
+    # rows are applied even if some are rejected, otherwise nothing is.
+    def ingest_batch(self, body, content_type, skip_invalid=False):
+        frame, errors = validate_ingest_rows(parse_ingest_batch(body, content_type), self.exog_vars)
+        summary = {"received": len(frame) + len(errors), "rejected": len(errors),
+                   "errors": errors[:INGEST_ERRORS_REPORTED]}
+        if (errors and not skip_invalid) or frame.empty:
+            summary["accepted"] = 0
+            return summary
+        statuses = self.ingest_frame(frame)
+        counts = Counter(statuses.values())
+        summary.update({"accepted": len(frame), "products": len(statuses),
+                        "models": {status: counts.get(status, 0) for status in ("updated", "invalidated", "none")}})
+        return summary
+
+    # Forecast and stockout simulation for [start_date, end_date], served from
+    # the forecast cache when an entry with the same start date covers the
+    # range. Returns the (sliced) forecast frame, the stockout result and the
+    # cache entry, which also holds rendered plots keyed by end date.
+    def cached_prediction(self, product_id, start_date, end_date):
+        if product_id not in self.product_set:
+            raise ValueError("Invalid product_id")
+        start_date = pd.to_datetime(start_date)
+        end_date = pd.to_datetime(end_date)
+        self.get_model(product_id)
+        version = self.model_version(product_id)
+
+        entry = self.forecast_cache.get(product_id, version, start_date, end_date)
+        if entry is None:
+            forecast_df = self.forecast(product_id, start_date, end_date)
+            stock = self.stock_levels(product_id, forecast_df)
+            entry = self.forecast_cache.put(product_id, version, start_date, end_date,
+                                            {"forecast": forecast_df, "stock": stock,
+                                             "result": self.stockout_result(product_id, stock)})
+
+        days = (end_date - start_date).days + 1
+        forecast_df = entry["forecast"].iloc[:days]
+        stock = entry["stock"].iloc[:days]
+        # A valid simulation's prefix is the simulation of the shorter range,
+        # but validity is judged over the whole range, so a shorter range
+        # whose verdict differs (or an error entry) is simulated on its own
+        if days < len(entry["stock"]) and ("error" in entry["result"] or self.invalid_stock(stock)):
+            return forecast_df, self.stockout_result(product_id, stock), entry
+        result = {key: value[:days] if isinstance(value, list) else value for key, value in entry["result"].items()}
+        return forecast_df, result, entry
+
+    def predict_result(self, product_id, start_date, end_date, include_probability=False):
+        forecast_df, result, _ = self.cached_prediction(product_id, start_date, end_date)
+        result["mae"] = self.calc_mae(product_id, forecast_df, start_date, end_date)
+        if include_probability and "error" not in result:
+            result.update(self.stockout_probability(product_id, start_date, end_date, forecast_df))
+        return result
+
+    # Runs every batch item for one product. Items sharing a start date share a
+    # single forecast over the longest requested horizon; shorter ones are
+    # prefixes of it, since each forecast step only depends on the steps before.
+    def predict_product_items(self, product_id, items):
+        results = {}
+        by_start = {}
+        for index, item in items:
+            try:
+                start_date, end_date = self.validate_range(item.start_date, item.end_date)
+                by_start.setdefault(start_date, []).append((index, item, end_date))
+            except Exception as e:
+                results[index] = {"error": str(e)}
+
+        # No model yet: answered from the fallback forecaster with the training
+        # queued, as /predict does. Products with too little data are never trained.
+        if product_id in self.product_set and not self.model_ready(product_id):
+            if self.data_poor(product_id):
+                model_status = "insufficient_data"
+            else:
+                model_status = self.training_scheduler.schedule(product_id, PRIORITY_REQUESTED)["status"]
+            for group in by_start.values():
+                for index, item, _ in group:
+                    try:
+                        results[index] = self.fallback_result(product_id, item.start_date, item.end_date)
+                        results[index]["model_status"] = model_status
+                    except Exception as e:
+                        results[index] = {"error": str(e)}
+            return results
+
+        for start_date, group in by_start.items():
+            try:
+                longest = max(end_date for _, _, end_date in group)
+                self.cached_prediction(product_id, start_date, longest)
+            except Exception as e:
+                for index, _, _ in group:
+                    results[index] = {"error": str(e)}
+                continue
+            for index, item, end_date in group:
+                try:
+                    results[index] = self.predict_result(product_id, item.start_date, item.end_date,
+                                                         item.include_probability)
+                except Exception as e:
+                    results[index] = {"error": str(e)}
+        return results
+
     @app.get("/products")
     async def get_products(self):
         logger.info("Received GET request for /products")
@@ -300,65 +2619,367 @@ class ForecastingService:
         return JSONResponse(content={})'''
 
     @app.post("/predict")
-    async def predict(self, req: PredictionRequest):
+    async def predict(self, req: PredictionRequest, request: Request):
         logger.info(f"Received POST request for /predict: {req}")
         try:
-            start_date = pd.to_datetime(req.start_date)
-            end_date = pd.to_datetime(req.end_date)
-            if start_date > end_date:
-                raise ValueError("start_date must be before end_date")
-            if start_date < self.df["Date"].min() or end_date > self.df["Date"].max() + pd.Timedelta(days=365):
-                raise ValueError("Date range outside available data")
-            
-            forecast_df = self.forecast(req.product_id, req.start_date, req.end_date)
-            result, plot = self.detect_stockout(req.product_id, forecast_df)
-            mae = self.calc_mae(req.product_id, forecast_df, req.start_date, req.end_date)
-            result["mae"] = mae
-            result["plot"] = plot
+            self.validate_range(req.start_date, req.end_date)
+            if req.product_id not in self.product_set:
+                raise ValueError("Invalid product_id")
+
+            # No model yet: answer from the fallback forecaster right away and
+            # queue the training, with a job to poll for the model-based answer.
+            # Products with too little data are never trained.
+            if not self.model_ready(req.product_id):
+                result = await self.run_cpu(self.fallback_result, req.product_id, req.start_date, req.end_date)
+                if self.data_poor(req.product_id):
+                    result["model_status"] = "insufficient_data"
+                else:
+                    job = self.training_scheduler.schedule(req.product_id, PRIORITY_REQUESTED)
+                    job_id = encode_job_id(req.product_id, req.start_date, req.end_date, req.include_probability)
+                    result.update({"model_status": job["status"], "job_id": job_id, "poll": f"/jobs/{job_id}"})
+                if req.include_plot and "error" not in result:
+                    png = await asyncio.get_running_loop().run_in_executor(
+                        self.plot_executor, self.result_plot_png, req.product_id, result)
+                    result["plot"] = base64.b64encode(png).decode("utf-8")
+                logger.info(f"Fallback prediction for {req.product_id} (model {result['model_status']})")
+                return self.respond(request, result)
+
+            result = await self.run_cpu(self.predict_result, req.product_id, req.start_date, req.end_date,
+                                        req.include_probability)
+            if req.include_plot and "error" not in result:
+                png = await asyncio.get_running_loop().run_in_executor(
+                    self.plot_executor, self.plot_png, req.product_id, req.start_date, req.end_date)
+                result["plot"] = base64.b64encode(png).decode("utf-8")
             
             logger.info(f"Prediction successful for product_id {req.product_id}")
-            return JSONResponse(content=result)
+            return self.respond(request, result)
+        except (ServiceOverloaded, asyncio.TimeoutError) as e:
+            return self.overload_response(e)
         except Exception as e:
             logger.error(f"Predict error: {e}")
             return JSONResponse(content={"error": str(e)}, status_code=400)
 
+    # Polls a prediction job from /predict. Returns the prediction once the
+    # model is ready, 202 with the training status while it isn't.
+    @app.get("/jobs/{job_id}")
+    async def job_status(self, job_id: str, request: Request):
+        try:
+            product_id, start_date, end_date, include_probability = decode_job_id(job_id)
+        except Exception:
+            return JSONResponse(content={"error": "Unknown job id"}, status_code=404)
+        if product_id not in self.product_set:
+            return JSONResponse(content={"error": "Unknown job id"}, status_code=404)
+        try:
+            if self.model_ready(product_id):
+                result = await self.run_cpu(self.predict_result, product_id, start_date, end_date, include_probability)
+                return self.respond(request, {"job_id": job_id, "status": "done", "result": result})
+            # Also (re)queues jobs this replica doesn't know about, e.g. queued on
+            # another replica or lost in a restart; single-flight training keeps
+            # that from fitting twice. A failed product is only retried once
+            # its backoff has passed.
+            job = self.training_scheduler.schedule(product_id, PRIORITY_REQUESTED)
+            return self.job_response(job_id, job)
+        except (ServiceOverloaded, asyncio.TimeoutError) as e:
+            return self.overload_response(e)
+        except Exception as e:
+            logger.error(f"Job status error: {e}")
+            return JSONResponse(content={"error": str(e)}, status_code=400)
+
+    @app.get("/plot/{product_id}")
+    async def plot(self, product_id: str, start_date: str, end_date: str):
+        logger.info(f"Received GET request for /plot/{product_id}: {start_date} to {end_date}")
+        try:
+            self.validate_range(start_date, end_date)
+            if product_id not in self.product_set:
+                raise ValueError("Invalid product_id")
+            # No model yet: the fallback forecast is plotted and the training
+            # queued, as /predict does. Otherwise the model load and forecast
+            # run on the CPU pool, leaving the plot pool only the rendering.
+            if not self.model_ready(product_id):
+                if not self.data_poor(product_id):
+                    self.training_scheduler.schedule(product_id, PRIORITY_REQUESTED)
+                render = self.fallback_plot_png
+            else:
+                await self.run_cpu(self.cached_prediction, product_id, start_date, end_date)
+                render = self.plot_png
+            png = await asyncio.get_running_loop().run_in_executor(
+                self.plot_executor, render, product_id, start_date, end_date)
+            return Response(content=png, media_type="image/png")
+        except (ServiceOverloaded, asyncio.TimeoutError) as e:
+            return self.overload_response(e)
+        except Exception as e:
+            logger.error(f"Plot error: {e}")
+            return JSONResponse(content={"error": str(e)}, status_code=400)
+
+    @app.get("/models")
+    async def models(self):
+        return JSONResponse(content=MODEL_REGISTRY.all())
+
+    @app.get("/cache/stats")
+    async def cache_stats(self):
+        return JSONResponse(content=self.forecast_cache.stats())
+
+    @app.get("/jobs")
+    async def jobs(self):
+        return JSONResponse(content=self.training_scheduler.stats())
+
+    def respond(self, request, content):
+        with self.metrics.stage("serialization"):
+            return negotiated_response(request, content)
+
+    def metric_values(self):
+        cache = self.forecast_cache.stats()
+        training = self.training_scheduler.stats()
+        return {
+            "forecast_cache_entries": cache["entries"],
+            "forecast_cache_hits": cache["hits"],
+            "forecast_cache_misses": cache["misses"],
+            "forecast_cache_hit_rate": cache["hit_rate"] or 0,
+            "models_in_memory": len(self.fitted_models),
+            "training_queue_depth": training["queued"],
+            "training_running": training["running"],
+            "training_failed": training["failed"],
+            "dataset_products": len(self.partitions),
+            "dataset_rows": self.partitions.row_count(),
+            "ingest_pending_frames": self.ingest_log.pending,
+        }
+
+    @app.get("/metrics")
+    async def prometheus_metrics(self):
+        return Response(content=self.metrics.render(self.metric_values()), media_type=CONTENT_TYPE_LATEST)
+
+    # Sampling profiler, opt-in with PROFILER_ENABLED=1. Start a profile, run
+    # some load, then stop it to get collapsed stacks for a flame graph.
+    @app.post("/profile/start")
+    async def profile_start(self, interval_ms: float | None = None):
+        if not PROFILER_ENABLED:
+            return JSONResponse(content={"error": "Profiling is disabled; set PROFILER_ENABLED=1"}, status_code=403)
+        interval_s = interval_ms / 1000 if interval_ms else PROFILE_INTERVAL_S
+        try:
+            self.profiler.start(interval_s)
+        except RuntimeError as e:
+            return JSONResponse(content={"error": str(e)}, status_code=409)
+        logger.info(f"Sampling profiler started ({interval_s * 1000:.1f}ms interval)")
+        return JSONResponse(content={"message": "Profiling started", "interval_s": interval_s})
+
+    @app.post("/profile/stop")
+    async def profile_stop(self):
+        if not PROFILER_ENABLED:
+            return JSONResponse(content={"error": "Profiling is disabled; set PROFILER_ENABLED=1"}, status_code=403)
+        try:
+            report = self.profiler.stop()
+        except RuntimeError as e:
+            return JSONResponse(content={"error": str(e)}, status_code=409)
+        logger.info(f"Sampling profiler stopped after {self.profiler.samples} samples")
+        return Response(content=report, media_type="text/plain")
+
+    @app.get("/profile")
+    async def profile_status(self, top: int = 20):
+        if not PROFILER_ENABLED:
+            return JSONResponse(content={"error": "Profiling is disabled; set PROFILER_ENABLED=1"}, status_code=403)
+        return JSONResponse(content=self.profiler.status(top))
+
+    @app.post("/predict_batch")
+    async def predict_batch(self, req: BatchPredictionRequest, request: Request):
+        logger.info(f"Received POST request for /predict_batch with {len(req.items)} items")
+        by_product = {}
+        for index, item in enumerate(req.items):
+            by_product.setdefault(item.product_id, []).append((index, item))
+
+        # At most CPU_WORKERS product groups of one batch in flight, so a large
+        # batch queues behind itself instead of tripping backpressure
+        batch_slots = asyncio.Semaphore(CPU_WORKERS)
+
+        async def run_group(product_id, items):
+            async with batch_slots:
+                try:
+                    return await self.run_cpu(self.predict_product_items, product_id, items)
+                except (ServiceOverloaded, asyncio.TimeoutError) as e:
+                    message = str(e) or f"Timed out after {REQUEST_TIMEOUT_S}s"
+                    return {index: {"error": message} for index, _ in items}
+
+        groups = await asyncio.gather(*[run_group(product_id, items) for product_id, items in by_product.items()])
+        results = {}
+        for group in groups:
+            results.update(group)
+
+        # Columnar response: per-item columns plus one flat set of per-day rows
+        # tagged with the index of the item they belong to. Items answered
+        # without a model have fallback set and their model's status.
+        response = {
+            "count": len(req.items),
+            "product_id": [item.product_id for item in req.items],
+            "start_date": [item.start_date for item in req.items],
+            "end_date": [item.end_date for item in req.items],
+            "mae": [], "error": [], "fallback": [], "model_status": [],
+            "rows": {"item": [], "date": [], "forecasted_demand": [], "current_stock_level": [],
+                     "remaining_stock_level": [], "stockout": []}
+        }
+        rows = response["rows"]
+        for index in range(len(req.items)):
+            result = results[index]
+            response["error"].append(result.get("error"))
+            response["mae"].append(result.get("mae"))
+            response["fallback"].append(result.get("fallback", False))
+            response["model_status"].append(result.get("model_status"))
+            if "error" in result:
+                continue
+            rows["item"].extend([index] * len(result["dates"]))
+            rows["date"].extend(result["dates"])
+            rows["forecasted_demand"].extend(result["forecasted_demand"])
+            rows["current_stock_level"].extend(result["current_stock_level"])
+            rows["remaining_stock_level"].extend(result["remaining_stock_level"])
+            rows["stockout"].extend(result["stockout"])
+
+        failed = sum(error is not None for error in response["error"])
+        logger.info(f"Batch prediction finished: {len(req.items) - failed} succeeded, {failed} failed")
+        return self.respond(request, response)
+
     @app.post("/add_data")
     async def add_data(self, req: NewDataRequest):
         logger.info(f"Received POST request for /add_data: {req}")
         try:
-            prev_data = self.df[self.df["product_id"] == req.product_id]
-            reorder = prev_data["Reorder Point"].iloc[-1] if not prev_data.empty else 0
-            lead_time = prev_data["Lead Time (Days)"].iloc[-1] if not prev_data.empty else 0
-
-            new_row = {
-                "product_id": req.product_id,
-                "Date": pd.to_datetime(req.date),
-                "Sales Volume": req.sales_volume,
-                "Opening Stock Level": req.opening_stock_level,
-                "Remaining Stock Level": req.remaining_stock_level,
-                "Reorder Point": reorder,
-                "Lead Time (Days)": lead_time
-            }
-            for var in EXOG_VARS:
-                new_row[var] = getattr(req, var, prev_data[var].iloc[-1] if var in prev_data and not prev_data.empty else 0)
-
-            new_row = pd.DataFrame([new_row])
-            self.df = pd.concat([self.df, new_row], ignore_index=True)
-            self.df.to_csv(DATA_PATH, index=False)
-
-            model_path = os.path.join(MODEL_DIR, f"sarima_{req.product_id}.pkl")
-            if os.path.exists(model_path):
-                os.remove(model_path)
-            if req.product_id in self.fitted_models:
-                del self.fitted_models[req.product_id]
+            model_status = await self.run_cpu(self.ingest_row, req)
 
-            logger.info(f"Data added successfully for product_id {req.product_id}")
+            logger.info(f"Data added successfully for product_id {req.product_id} (model {model_status})")
+            if model_status == "updated":
+                return JSONResponse(content={"message": "Data added successfully. Model updated incrementally."})
             return JSONResponse(content={"message": "Data added successfully. Model will be updated lazily."})
+        except (ServiceOverloaded, asyncio.TimeoutError) as e:
+            return self.overload_response(e)
         except Exception as e:
             logger.error(f"Add data error: {e}")
             return JSONResponse(content={"error": str(e)})
 
+    # Bulk ingestion: NDJSON (one /add_data object per line) or CSV with the
+    # same field names, read from the request stream. The whole batch is one
+    # ingestion log record and each product's model is updated once. Rejected
+    # rows make it a 422 unless skip_invalid is set.
+    @app.post("/add_data_batch")
+    async def add_data_batch(self, request: Request, skip_invalid: bool = False):
+        content_type = request.headers.get("content-type", "")
+        logger.info(f"Received POST request for /add_data_batch ({content_type or 'no content type'})")
+        try:
+            body = bytearray()
+            async for chunk in request.stream():
+                body.extend(chunk)
+                if len(body) > MAX_INGEST_BATCH_BYTES:
+                    return JSONResponse(content={"error": f"Batch larger than {MAX_INGEST_BATCH_BYTES} bytes"},
+                                        status_code=413)
+            summary = await self.run_cpu(self.ingest_batch, bytes(body), content_type, skip_invalid)
+            if summary["accepted"] == 0:
+                logger.warning(f"Batch rejected: {summary['rejected']} of {summary['received']} rows invalid")
+                return JSONResponse(content={"error": "Batch rejected", **summary}, status_code=422)
+            logger.info(f"Batch ingested: {summary['accepted']} rows for {summary['products']} products, "
+                        f"models {summary['models']}")
+            return JSONResponse(content=summary)
+        except (ServiceOverloaded, asyncio.TimeoutError) as e:
+            return self.overload_response(e)
+        except Exception as e:
+            logger.error(f"Add data batch error: {e}")
+            return JSONResponse(content={"error": str(e)}, status_code=400)
+
+    @app.post("/admin/train_all")
+    async def train_all(self, req: TrainAllRequest):
+        logger.info(f"Received POST request for /admin/train_all: {req}")
+        try:
+            product_ids = req.product_ids or self.product_ids
+            with self.bulk_lock:
+                if self.bulk_job is not None:
+                    return JSONResponse(content={"error": "Bulk training is already running",
+                                                 "job_id": self.bulk_job,
+                                                 "poll": f"/admin/train_all/{self.bulk_job}"}, status_code=409)
+                job_id = uuid.uuid4().hex
+                self.bulk_job = job_id
+            if req.force:
+                self.training_scheduler.clear_failures(product_ids)
+            state = {"job_id": job_id, "status": "running",
+                     "started_at": datetime.now().isoformat(timespec="seconds"),
+                     "total": len(product_ids), "done": 0,
+                     "summary": {"trained": 0, "skipped": 0, "failed": 0}}
+            write_bulk_job(state)
+            threading.Thread(target=self.run_bulk_training, args=(state, product_ids, req),
+                             name=f"train-all-{job_id[:8]}", daemon=True).start()
+            return JSONResponse(content={"job_id": job_id, "status": "running", "total": len(product_ids),
+                                         "poll": f"/admin/train_all/{job_id}"}, status_code=202)
+        except Exception as e:
+            with self.bulk_lock:
+                self.bulk_job = None
+            logger.error(f"Bulk training error: {e}")
+            return JSONResponse(content={"error": str(e)}, status_code=500)
+
+    @app.get("/admin/train_all/{job_id}")
+    async def train_all_status(self, job_id: str):
+        state = read_bulk_job(job_id)
+        if state is None:
+            return JSONResponse(content={"error": "Unknown job id"}, status_code=404)
+        return JSONResponse(content=state)
+
+    # Runs a bulk training job off the request path. Progress is written at
+    # most once a second; the final state carries the full report.
+    def run_bulk_training(self, state, product_ids, req):
+        last_write = time.monotonic()
+
+        def on_result(product_id, result):
+            nonlocal last_write
+            state["done"] += 1
+            state["summary"][result["status"]] += 1
+            if time.monotonic() - last_write >= 1.0:
+                write_bulk_job(state)
+                last_write = time.monotonic()
+
+        try:
+            report = train_all_models(self.partitions, product_ids, max_workers=req.max_workers,
+                                      force=req.force, on_trained=self.on_model_trained, on_result=on_result)
+            state.update(status="done", summary=report["summary"], report=report)
+        except Exception as e:
+            logger.error(f"Bulk training error: {e}")
+            state.update(status="failed", error=str(e))
+        finally:
+            state["finished_at"] = datetime.now().isoformat(timespec="seconds")
+            try:
+                write_bulk_job(state)
+            finally:
+                with self.bulk_lock:
+                    self.bulk_job = None
+
+    @app.post("/admin/backtest")
+    async def backtest(self, req: BacktestRequest):
+        logger.info(f"Received POST request for /admin/backtest: {req}")
+        if min(req.cutoffs, req.step_days, req.horizon) < 1:
+            return JSONResponse(content={"error": "cutoffs, step_days and horizon must be positive"}, status_code=400)
+        try:
+            product_ids = req.product_ids or self.product_ids
+            report = await asyncio.get_running_loop().run_in_executor(
+                None, lambda: run_backtest(self.partitions, product_ids, max_workers=req.max_workers,
+                                           cutoffs=req.cutoffs, step=req.step_days, horizon=req.horizon))
+            return JSONResponse(content=report)
+        except Exception as e:
+            logger.error(f"Backtest error: {e}")
+            return JSONResponse(content={"error": str(e)}, status_code=500)
+
+    # The last backtest report, or one product's entry from it
+    @app.get("/backtest")
+    async def backtest_report(self, product_id: str | None = None):
+        if not os.path.exists(BACKTEST_REPORT_PATH):
+            return JSONResponse(content={"error": "No backtest has been run; POST /admin/backtest"}, status_code=404)
+        with open(BACKTEST_REPORT_PATH) as f:
+            report = json.load(f)
+        if product_id is None:
+            return JSONResponse(content=report)
+        if product_id not in report["products"]:
+            return JSONResponse(content={"error": f"{product_id} is not in the last backtest"}, status_code=404)
+        return JSONResponse(content={"config": report["config"], "finished_at": report["finished_at"],
+                                     **report["products"][product_id]})
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Demand forecasting service")
+    parser.add_argument("--train-all", action="store_true", help="Pre-train models for every product and exit")
+    parser.add_argument("--force", action="store_true", help="Retrain products that already have a model artifact")
+    parser.add_argument("--backtest", action="store_true", help="Run a rolling-origin backtest of every product and exit")
+    parser.add_argument("--workers", type=int, default=None, help="Maximum concurrent training or backtest tasks (default: available CPUs)")
+    args = parser.parse_args()
+
     try:
         # Try connecting to the cluster, fall back to local if it fails
         try:
@@ -368,6 +2989,20 @@ if __name__ == "__main__":
             logger.warning(f"Failed to connect to Ray cluster: {e}. Initializing local Ray instance.")
             ray.init(ignore_reinit_error=True)
             logger.info("Initialized local Ray instance")
+
+        if args.train_all:
+            partitions = PartitionStore(build_store(load_dataset()))
+            report = train_all_models(partitions, sorted(partitions), max_workers=args.workers, force=args.force)
+            print(f"Bulk training finished: {report['summary']}. Report written to {TRAINING_REPORT_PATH}")
+            raise SystemExit(1 if report["summary"]["failed"] else 0)
+
+        if args.backtest:
+            partitions = PartitionStore(build_store(load_dataset()))
+            report = run_backtest(partitions, sorted(partitions), max_workers=args.workers)
+            summary = report["summary"]
+            print(f"Backtest finished: {summary['backtested']} products, MAE {summary['mae']}, MAPE {summary['mape']}, "
+                  f"stockout hit rate {summary['stockout_hit_rate']}. Report written to {BACKTEST_REPORT_PATH}")
+            raise SystemExit(1 if summary["failed"] else 0)
         
         try:
             serve.delete("default")
@@ -381,7 +3016,6 @@ if __name__ == "__main__":
         print("Ray Serve is running on http://0.0.0.0:8000")
         print("Access the API documentation at http://0.0.0.0:8000/docs")
         
-        import time
         while True:
             time.sleep(3600)
     except Exception as e: